@@ -0,0 +1,70 @@
+# batcher.py
+
+import threading
+import time
+import traceback
+
+
+class UploadBatcher:
+    """
+    Debounces incoming files per user. A user's batch is flushed once no file has
+    arrived for `idle` seconds, or as soon as it reaches `max_files` files or
+    `max_bytes` bytes. A single thread keeps track of all the idle deadlines.
+    `flush` is called with the user id and the items added since the last flush.
+    """
+
+    def __init__(self, flush, idle=20, max_files=10, max_bytes=50 * 1024 * 1024):
+        self.flush = flush
+        self.idle = idle
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._batches = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='upload-batcher', daemon=True)
+        self._thread.start()
+
+    def pending(self):
+        with self._cond:
+            return sum(len(items) for items, _, _ in self._batches.values())
+
+    def add(self, user_id, item, size):
+        with self._cond:
+            items, total, _ = self._batches.get(user_id, ([], 0, None))
+            items.append(item)
+            total += size
+            if len(items) >= self.max_files or total >= self.max_bytes:
+                self._batches.pop(user_id, None)
+                flush_now = True
+            else:
+                self._batches[user_id] = (items, total, time.monotonic() + self.idle)
+                self._cond.notify()
+                flush_now = False
+        if flush_now:
+            self._flush(user_id, items)
+
+    def discard(self, user_id):
+        with self._cond:
+            self._batches.pop(user_id, None)
+
+    def _flush(self, user_id, items):
+        try:
+            self.flush(user_id, items)
+        except Exception:
+            traceback.print_exc()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [(user_id, items) for user_id, (items, _, deadline) in self._batches.items() if deadline <= now]
+                for user_id, _ in due:
+                    del self._batches[user_id]
+                if not due:
+                    deadlines = [deadline for _, _, deadline in self._batches.values()]
+                    self._cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+            for user_id, items in due:
+                self._flush(user_id, items)
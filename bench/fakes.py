@@ -0,0 +1,266 @@
+# fakes.py
+
+import hashlib
+import json
+import random
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class Faults:
+    """
+    Latency, bandwidth and error rate injected into a fake server's responses.
+    `bandwidth` is in bytes per second per transfer, None for unlimited.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def fail(self):
+        return random.random() < self.error_rate
+
+    def throttle(self, nbytes):
+        if self.bandwidth:
+            time.sleep(nbytes / self.bandwidth)
+
+
+class FakeServer:
+    def __init__(self, faults=None, host='127.0.0.1', port=0):
+        self.faults = faults or Faults()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        # Clients dropping their connections, e.g. the bot being stopped, are not errors here
+        self.httpd.handle_error = lambda request, client_address: None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server.faults.delay()
+                server.handle(self)
+
+            do_POST = do_GET
+
+            def read_body(self):
+                left = int(self.headers.get('Content-Length', 0))
+                chunks = []
+                while left > 0:
+                    chunk = self.rfile.read(min(Faults.CHUNK_SIZE, left))
+                    if not chunk:
+                        break
+                    server.faults.throttle(len(chunk))
+                    chunks.append(chunk)
+                    left -= len(chunk)
+                return b''.join(chunks)
+
+            def reply(self, status, body=b'', content_type='application/json'):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                for i in range(0, len(body), Faults.CHUNK_SIZE):
+                    self.wfile.write(body[i:i + Faults.CHUNK_SIZE])
+                    server.faults.throttle(min(Faults.CHUNK_SIZE, len(body) - i))
+
+        return Handler
+
+    def handle(self, request):
+        raise NotImplementedError
+
+
+class FakeTelegram(FakeServer):
+    """
+    Stand-in for the Bot API: getUpdates long polling over updates queued with add_audio(),
+    getFile and file downloads, and the methods the bot sends messages with. Message
+    methods fail with 429 at the error rate; everything sent is recorded in `sent`.
+    """
+
+    FAULTY = ('sendMessage', 'editMessageText', 'deleteMessage')
+
+    def __init__(self, faults=None, host='127.0.0.1', port=0):
+        super().__init__(faults, host, port)
+        self.updates = []
+        self.files = {}
+        self.sent = []
+        self._cond = threading.Condition()
+        self._update_id = 0
+        self._message_id = 0
+        self.polled = threading.Event()
+
+    @property
+    def api_url(self):
+        return self.url
+
+    def _next_message_id(self):
+        with self._cond:
+            self._message_id += 1
+            return self._message_id
+
+    def add_audio(self, chat_id, title, data):
+        """
+        Queues a message with an audio file from `chat_id`. Returns when it was queued.
+        """
+        file_unique_id = hashlib.md5(data).hexdigest()[:16]
+        file_id = f'file-{file_unique_id}'
+        self.files[file_id] = data
+        with self._cond:
+            self._update_id += 1
+            self._message_id += 1
+            self.updates.append({
+                'update_id': self._update_id,
+                'message': {
+                    'message_id': self._message_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+                    'audio': {'file_id': file_id, 'file_unique_id': file_unique_id, 'duration': 1,
+                              'title': title, 'file_size': len(data)},
+                },
+            })
+            self._cond.notify_all()
+        return time.monotonic()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return list(self.updates[:100])
+                self._cond.wait(remaining)
+
+    def message(self, chat_id, text=None):
+        return {'message_id': self._next_message_id(), 'date': int(time.time()),
+                'chat': {'id': int(chat_id), 'type': 'private'}, 'text': text}
+
+    def handle(self, request):
+        parts = urlparse(request.path)
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        if request.command == 'POST' and request.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            params.update({key: values[0] for key, values in parse_qs(request.read_body().decode()).items()})
+        elif request.command == 'POST':
+            request.read_body()
+
+        path = parts.path.split('/')
+        if len(path) > 3 and path[1] == 'file':
+            data = self.files.get('/'.join(path[3:]))
+            if data is None:
+                return request.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return request.reply(200, data, 'application/octet-stream')
+
+        method = path[-1]
+        if method in self.FAULTY and self.faults.fail():
+            return request.reply(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                                       'parameters': {'retry_after': 1}})
+        if method == 'getUpdates':
+            self.polled.set()
+            result = self.get_updates(int(params.get('offset', 0)), min(float(params.get('timeout', 20)), 5))
+        elif method == 'getFile':
+            data = self.files.get(params.get('file_id'))
+            if data is None:
+                return request.reply(400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: invalid file_id'})
+            result = {'file_id': params['file_id'], 'file_unique_id': params['file_id'][5:],
+                      'file_size': len(data), 'file_path': params['file_id']}
+        elif method in ('sendMessage', 'editMessageText'):
+            self.sent.append((time.monotonic(), method, params.get('chat_id'), params.get('text')))
+            result = self.message(params.get('chat_id'), params.get('text'))
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        else:
+            # deleteMessage, answerCallbackQuery, deleteWebhook, ...
+            result = True
+        request.reply(200, {'ok': True, 'result': result})
+
+
+class FakeIBroadcast(FakeServer):
+    """
+    Stand-in for the iBroadcast JSON API (login and status) and the upload endpoint (MD5
+    list and multipart uploads). Uploads fail with 503 at the error rate; completed ones
+    are recorded in `uploads` as filename -> (time, md5).
+    """
+
+    def __init__(self, faults=None, host='127.0.0.1', port=0):
+        super().__init__(faults, host, port)
+        self.uploads = {}
+        self.md5s = set()
+        self._cond = threading.Condition()
+
+    @property
+    def api_url(self):
+        return f'{self.url}/s/JSON/'
+
+    @property
+    def upload_url(self):
+        return f'{self.url}/upload'
+
+    def wait_for_uploads(self, count, idle_timeout):
+        """
+        Waits until `count` files were uploaded, or nothing arrived for `idle_timeout` seconds.
+        """
+        with self._cond:
+            while len(self.uploads) < count:
+                before = len(self.uploads)
+                self._cond.wait(idle_timeout)
+                if len(self.uploads) == before:
+                    break
+            return len(self.uploads)
+
+    def handle(self, request):
+        content_type = request.headers.get('Content-Type', '')
+        body = request.read_body()
+        if request.path.startswith('/s/JSON'):
+            data = json.loads(body or b'{}')
+            if data.get('mode') == 'login_token':
+                return request.reply(200, {'result': True, 'user': {'id': data.get('login_token'), 'token': 'token'}})
+            return request.reply(200, {'result': True, 'user': {'id': data.get('user_id')},
+                                       'supported': [{'extension': '.mp3'}, {'extension': '.flac'}]})
+
+        if not content_type.startswith('multipart/form-data'):
+            with self._cond:
+                return request.reply(200, {'result': True, 'md5': sorted(self.md5s)})
+
+        if self.faults.fail():
+            return request.reply(503, {'result': False})
+        message = BytesParser(policy=policy.default).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        part = next(part for part in message.iter_parts() if part.get_filename())
+        md5 = hashlib.md5(part.get_payload(decode=True)).hexdigest()
+        with self._cond:
+            self.md5s.add(md5)
+            self.uploads[part.get_filename()] = (time.monotonic(), md5)
+            self._cond.notify_all()
+        request.reply(200, {'result': True})
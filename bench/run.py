@@ -0,0 +1,118 @@
+# run.py
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from db import Database
+from fakes import Faults, FakeTelegram, FakeIBroadcast
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))], 3)
+
+
+def run(args):
+    telegram = FakeTelegram(Faults(args.tg_latency, args.tg_bandwidth, args.tg_error_rate)).start()
+    ibroadcast = FakeIBroadcast(Faults(args.ib_latency, args.ib_bandwidth, args.ib_error_rate)).start()
+
+    data_dir = tempfile.mkdtemp(prefix='ibroadcast-bench-')
+    # Users are logged in with auto upload on, so every track goes straight to iBroadcast
+    db = Database(os.path.join(data_dir, 'user_data.db'))
+    users = [1000 + i for i in range(args.users)]
+    for user_id in users:
+        db.log_in(user_id, f'login-{user_id}')
+        db.set_auto_upload(user_id, True)
+
+    env = dict(os.environ, TOKEN='1:bench', DATA_DIR=data_dir, TELEGRAM_API_URL=telegram.api_url,
+               IBROADCAST_API_URL=ibroadcast.api_url, IBROADCAST_UPLOAD_URL=ibroadcast.upload_url,
+               AUTO_UPLOAD_IDLE_SECONDS=str(args.batch_idle))
+    env.pop('WEBHOOK_URL', None)
+    env.update(setting.split('=', 1) for setting in args.env)
+    log = open(os.path.join(data_dir, 'bot.log'), 'w')
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bot.py')], env=env, stdout=log, stderr=log)
+    if not telegram.polled.wait(30):
+        bot.kill()
+        sys.exit(f'The bot did not start polling, see {log.name}')
+
+    queued = {}
+    for i in range(args.files):
+        for user_id in users:
+            title = f'bench-{user_id}-{i}'
+            queued[f'{title}.mp3'] = telegram.add_audio(user_id, title, os.urandom(args.size * 1024))
+        if args.interval:
+            time.sleep(args.interval)
+
+    uploaded = ibroadcast.wait_for_uploads(len(queued), args.idle_timeout)
+    # Reaped with wait4() for its resource usage, so the exit status is handed to Popen by hand
+    pid, status, rusage = os.wait4(bot.pid, os.WNOHANG)
+    exited_early = pid != 0
+    if not exited_early:
+        bot.terminate()
+        _, status, rusage = os.wait4(bot.pid, 0)
+    bot.returncode = os.waitstatus_to_exitcode(status)
+    if exited_early:
+        print(f'The bot exited with code {bot.returncode} before the run finished, see {log.name}', file=sys.stderr)
+    log.close()
+    telegram.stop()
+    ibroadcast.stop()
+
+    done = [name for name in queued if name in ibroadcast.uploads]
+    latencies = [ibroadcast.uploads[name][0] - queued[name] for name in done]
+    # From the first uploaded track being sent to the last upload arriving
+    elapsed = max(ibroadcast.uploads[name][0] for name in done) - min(queued[name] for name in done) if done else None
+    return {
+        'users': args.users,
+        'files': len(queued),
+        'uploaded': uploaded,
+        'seconds': round(elapsed, 3) if elapsed is not None else None,
+        'files_per_second': round(uploaded / elapsed, 2) if elapsed else None,
+        'p50_seconds': percentile(latencies, 50),
+        'p99_seconds': percentile(latencies, 99),
+        'messages_sent': len(telegram.sent),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        # -15 when it was stopped by the harness as usual
+        'exit_code': bot.returncode,
+        'log': log.name,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs bot.py against fake Telegram and iBroadcast servers and reports its throughput, latency and memory use.")
+
+    parser.add_argument('-u', '--users', type=int, default=10, help='Number of simulated users, 10 by default.')
+    parser.add_argument('-f', '--files', type=int, default=5, help='Tracks sent by each user, 5 by default.')
+    parser.add_argument('-s', '--size', type=int, default=512, metavar='KB', help='Size of each track, 512 KB by default.')
+    parser.add_argument('-i', '--interval', type=float, default=0, metavar='SECONDS', help='Pause between rounds of tracks, none by default.')
+    parser.add_argument('--tg-latency', type=float, default=0.0, metavar='SECONDS', help='Latency added to every Telegram request')
+    parser.add_argument('--tg-bandwidth', type=float, default=None, metavar='BYTES/S', help='Bandwidth of each Telegram file download')
+    parser.add_argument('--tg-error-rate', type=float, default=0.0, help='Share of sent messages answered with 429')
+    parser.add_argument('--ib-latency', type=float, default=0.0, metavar='SECONDS', help='Latency added to every iBroadcast request')
+    parser.add_argument('--ib-bandwidth', type=float, default=None, metavar='BYTES/S', help='Bandwidth of each iBroadcast upload')
+    parser.add_argument('--ib-error-rate', type=float, default=0.0, help='Share of uploads answered with 503')
+    parser.add_argument('--batch-idle', type=int, default=1, metavar='SECONDS', help='The bot\'s AUTO_UPLOAD_IDLE_SECONDS: auto uploads wait for this long after a user\'s last track, 1 by default.')
+    parser.add_argument('--idle-timeout', type=float, default=30, metavar='SECONDS', help='Give up when no upload arrived for this long, 30 by default. Must be longer than --batch-idle.')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='Extra setting for the bot, e.g. UPLOAD_WORKERS=6')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    args = parser.parse_args()
+    if args.idle_timeout <= args.batch_idle:
+        # The last batch of every user would never be waited for
+        parser.error('--idle-timeout must be longer than --batch-idle')
+    results = run(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f'{key}: {value}')
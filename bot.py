@@ -1,35 +1,96 @@
 import os
-import shutil
+import secrets
 import sqlite3
+import threading
 import time
+import traceback
+from urllib.parse import urlparse
 import telebot
 from telebot import types
-from script import Uploader 
+from script import Uploader, AuthError, RemoteMD5Cache, LocalMD5Cache, AdaptiveLimiter
+from session import SessionCache
+from jobs import JobQueue
+from db import Database
+from download import BotApiDownloader, MTProtoDownloader
+from file_index import FileIndex, QuotaExceeded, SpoolFull, PathTaken
+from spool import SpoolManager
+from pipeline import Pipeline, Stage
+from batcher import UploadBatcher
+from webhook import WebhookServer
+from cluster import Dispatcher, HashRing, serve
+from outbox import Outbox
+from progress import UploadProgress
+from metrics import Registry, Counter, Histogram, Gauge
 from pathlib import Path
 from messages import *  
 from dotenv import load_dotenv
 
 load_dotenv()
 
-bot = telebot.TeleBot(os.getenv('TOKEN'))
-
-uploader = None
-dir_path = Path(__file__).parent.absolute()
+webhook_url = os.getenv('WEBHOOK_URL')
+# With more than one process, a dispatcher routes every chat's updates to the worker that owns it
+worker_processes = int(os.getenv('WORKER_PROCESSES', 1))
+# Set by the dispatcher in the worker processes it starts
+shard_index = int(os.environ['SHARD_INDEX']) if os.getenv('SHARD_INDEX') else None
+shard_ring = HashRing(range(worker_processes))
+handler_threads = int(os.getenv('HANDLER_THREADS', 4))
+if os.getenv('TELEGRAM_API_URL'):
+    # e.g. a local Bot API server, or the fake one in bench/
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL').rstrip('/') + '/bot{0}/{1}'
+    telebot.apihelper.FILE_URL = os.getenv('TELEGRAM_API_URL').rstrip('/') + '/file/bot{0}/{1}'
+Uploader.API_URL = os.getenv('IBROADCAST_API_URL', Uploader.API_URL)
+Uploader.UPLOAD_URL = os.getenv('IBROADCAST_UPLOAD_URL', Uploader.UPLOAD_URL)
+# In webhook mode the webhook server runs handlers on its own bounded pool, and worker
+# processes run them on cluster.serve()'s threads
+bot = telebot.TeleBot(os.getenv('TOKEN'), threaded=not webhook_url and worker_processes == 1,
+                      num_threads=handler_threads)
+
+sessions = SessionCache(ttl=6 * 60 * 60)
+metrics = Registry()
+stage_seconds = metrics.add(Histogram('ibroadcast_bot_stage_seconds', 'Duration of download, hashing and iBroadcast calls',
+                                      ('stage', 'outcome')))
+pipeline_errors = metrics.add(Counter('ibroadcast_bot_pipeline_errors_total', 'Errors raised by receive pipeline stages',
+                                      ('stage', 'error')))
+
+
+def observe(stage, seconds, outcome):
+    stage_seconds.observe(seconds, stage, outcome)
+
+
+# Handlers queue their replies here instead of waiting on Telegram
+# Telegram's global limit is per bot, so the worker processes split it
+outbox = Outbox(bot, global_rate=25 / worker_processes, workers=int(os.getenv('OUTBOX_WORKERS', 4)))
+dir_path = Path(os.getenv('DATA_DIR') or Path(__file__).parent).absolute()
+os.makedirs(dir_path, exist_ok=True)
+if os.getenv('TELEGRAM_API_ID') and os.getenv('TELEGRAM_API_HASH'):
+    # MTProto is not limited to 20 MB files and fetches large ones in parallel ranges
+    downloader = MTProtoDownloader(bot, int(os.getenv('TELEGRAM_API_ID')), os.getenv('TELEGRAM_API_HASH'), dir_path,
+                                   parts_per_file=int(os.getenv('DOWNLOAD_PARTS', 4)),
+                                   max_parts=int(os.getenv('MAX_DOWNLOAD_PARTS', 8)),
+                                   # Processes cannot share a session file
+                                   name='mtproto_downloader' if shard_index is None else f'mtproto_downloader_{shard_index}')
+else:
+    downloader = BotApiDownloader(bot)
+downloader.observe = observe
 db_path = os.path.join(dir_path, 'user_data.db')
-user_path = None
-
-conn = sqlite3.connect(db_path, check_same_thread=False)
-c = conn.cursor()
-c.execute('''
-    CREATE TABLE IF NOT EXISTS users
-    (user_id TEXT PRIMARY KEY,
-    login_token TEXT, 
-    state TEXT DEFAULT 'logout',
-    first_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
-    last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    last_logout TIMESTAMP)
-''')
-conn.commit()
+library_md5s = RemoteMD5Cache(os.path.join(dir_path, 'library_md5s'), ttl=60 * 60)
+local_md5s = LocalMD5Cache(os.path.join(dir_path, 'local_md5s.db'))
+upload_workers = int(os.getenv('UPLOAD_WORKERS', 3))
+storage_limit_bytes = 100 * 1024 * 1024
+# Files per page of the list, which keeps a page well under Telegram's 4096 characters
+list_page_size = 10
+spool_budget_bytes = int(os.getenv('SPOOL_BUDGET_MB', 2048)) * 1024 * 1024
+spool_max_age = int(os.getenv('SPOOL_MAX_AGE_HOURS', 72)) * 60 * 60
+progress_interval = float(os.getenv('PROGRESS_INTERVAL', 3))
+# Caps the uploads in flight across all users, adapting to how the upload endpoint copes.
+# Every worker process gets its share of the cap.
+upload_limiter = AdaptiveLimiter(1, int(os.getenv('MAX_PARALLEL_UPLOADS', 12)) // worker_processes,
+                                 initial=upload_workers)
+# One keep-alive connection pool shared by every user's uploads
+http_session = Uploader.create_session(pool_size=upload_limiter.max_limit)
+
+db = Database(db_path)
+file_index = FileIndex(db)
 
 universal_markup = types.InlineKeyboardMarkup(row_width=2)
 
@@ -38,9 +99,11 @@ upload_button = types.InlineKeyboardButton("🎧 Upload", callback_data="upload"
 list_button = types.InlineKeyboardButton("📂 List", callback_data="list")
 logout_button = types.InlineKeyboardButton("❌ Logout", callback_data="logout")
 help_button = types.InlineKeyboardButton("❔ Help", callback_data="help")
+auto_button = types.InlineKeyboardButton("⚡ Auto upload", callback_data="auto")
 
 # Add buttons to the keyboard
 universal_markup.add(list_button, upload_button)
+universal_markup.add(auto_button)
 universal_markup.add(logout_button)
 universal_markup.add(help_button)
 
@@ -50,55 +113,74 @@ login_markup.add(types.InlineKeyboardButton(
     text="Login", callback_data="login"))
 
 
+def owns_user(user_id):
+    """
+    Whether this process looks after the user's sessions, spool directory and upload jobs.
+    """
+    return shard_index is None or shard_ring.node(user_id) == shard_index
+
+
+def new_uploader(login_token, user_id):
+    uploader = Uploader(login_token, directory=create_user_directory(user_id), no_cache=False, verbose=False,
+                        silent=True, skip_confirmation=True, parallel_uploads=3, playlist=None, tag=None,
+                        reupload=False)
+    uploader.md5_ext_cache = library_md5s
+    uploader.md5_int = local_md5s
+    uploader.session = http_session
+    uploader.limiter = upload_limiter
+    uploader.observe = observe
+    return uploader
+
+
 def ask_for_login_token(message: telebot.types.Message):
-    global uploader, user_path
     user_id = message.chat.id
     login_token = message.text.strip()
-    user_path = os.path.join(dir_path, 'uploads', str(user_id))
-    uploader = Uploader(login_token, directory=user_path, no_cache=False, verbose=False, silent=False,
-                        skip_confirmation=True, parallel_uploads=3, playlist=None, tag=None, reupload=True)
+    uploader = new_uploader(login_token, user_id)
     try:
         uploader.login()
-        c.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-        if c.fetchone() is None:
-            c.execute("INSERT INTO users (user_id, login_token, state, first_login, last_login) VALUES (?, ?, 'login', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)",
-                      (user_id, login_token))
-        else:
-            c.execute("UPDATE users SET login_token = ?, state = 'login', last_login = CURRENT_TIMESTAMP WHERE user_id = ?",
-                      (login_token, user_id))
-        conn.commit()
-        bot.send_message(message.chat.id, login_successful,
-                         reply_markup=universal_markup, parse_mode='Markdown')
+        uploader.get_supported_types()
+        db.log_in(user_id, login_token)
+        sessions.put(user_id, login_token, uploader.user_id, uploader.token, uploader.supported)
+        outbox.send_message(message.chat.id, login_successful,
+                            reply_markup=universal_markup, parse_mode='Markdown')
     except sqlite3.Error as e:
-        bot.send_message(message.chat.id, database_error(e),
-                         parse_mode='Markdown')
+        outbox.send_message(message.chat.id, database_error(e),
+                            parse_mode='Markdown')
     except Exception as e:
-        bot.send_message(message.chat.id, login_failed(e),
-                         parse_mode='Markdown')
+        outbox.send_message(message.chat.id, login_failed(e),
+                            parse_mode='Markdown')
+
+
+def open_session(user_id):
+    session = sessions.get(user_id)
+    if session:
+        uploader = new_uploader(session.login_token, user_id)
+        uploader.resume_session(session.user_id, session.token, session.supported)
+        return uploader
+    login_token = db.login_token(user_id)
+    if login_token is None:
+        return None
+    uploader = new_uploader(login_token, user_id)
+    uploader.login()
+    uploader.get_supported_types()
+    sessions.put(user_id, login_token, uploader.user_id, uploader.token, uploader.supported)
+    return uploader
 
 
 def is_user_logged_in(user_id):
-    global uploader, user_path
-    user_path = os.path.join(dir_path, 'uploads', str(user_id))
-    create_user_directory(user_id)
-    c.execute(
-        "SELECT login_token FROM users WHERE user_id = ? AND state = 'login'", (user_id,))
-    result = c.fetchone()
-    if result:
-        uploader = Uploader(result[0], directory=user_path, no_cache=False, verbose=False, silent=False,
-                            skip_confirmation=True, parallel_uploads=3, playlist=None, tag=None, reupload=True)
-        try:
-            uploader.login()
-            return True
-        except Exception as e:
-            print(e)
+    try:
+        return open_session(user_id) is not None
+    except sqlite3.Error:
+        raise
+    except Exception as e:
+        print(e)
     return False
 
 
 def create_user_directory(user_id):
     directory = os.path.join(dir_path, 'uploads', str(user_id))
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
     return directory
 
 
@@ -108,103 +190,180 @@ def sanitize_filename(filename):
         filename = filename.replace(char, '')
     return filename
 
-def get_folder_size(path):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-
-def delete_files(directory, message: telebot.types.Message):
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            bot.send_message(
-                message.chat.id, f"*❌ Error: {e}*", parse_mode='Markdown')
+def list_user_files(directory):
+    # Skip in-progress downloads, which are kept as hidden temp files
+    return [f for f in os.listdir(directory) if not f.startswith('.')]
 
 
 def handle_login(call: telebot.types.CallbackQuery):
-    msg = bot.send_message(call.message.chat.id,
-                           "🔑 Please enter your login token:")
-    bot.register_next_step_handler(msg, ask_for_login_token)
+    outbox.send_message(call.message.chat.id, "🔑 Please enter your login token:")
+    bot.register_next_step_handler_by_chat_id(call.message.chat.id, ask_for_login_token)
 
 
 def handle_logout(call: telebot.types.CallbackQuery):
-    global uploader
-    uploader = None
-    c.execute("UPDATE users SET state = 'logout', last_logout = CURRENT_TIMESTAMP WHERE user_id = ?",
-              (call.message.chat.id,))
-    conn.commit()
-    bot.send_message(call.message.chat.id, logout_successful,
-                     parse_mode='Markdown')
+    sessions.invalidate(call.message.chat.id)
+    db.log_out(call.message.chat.id)
+    outbox.send_message(call.message.chat.id, logout_successful,
+                        parse_mode='Markdown')
 
 
 def handle_upload(call: telebot.types.CallbackQuery):
-    global uploader, user_path
     if not is_user_logged_in(call.message.chat.id):
-        bot.send_message(call.message.chat.id, login_first,
-                         reply_markup=login_markup, parse_mode='Markdown')
+        outbox.send_message(call.message.chat.id, login_first,
+                            reply_markup=login_markup, parse_mode='Markdown')
         return
-    if not os.listdir(user_path):
-        bot.send_message(call.message.chat.id, empty_list,
-                         reply_markup=universal_markup, parse_mode='Markdown')
+    if not list_user_files(create_user_directory(call.message.chat.id)):
+        outbox.send_message(call.message.chat.id, empty_list,
+                            reply_markup=universal_markup, parse_mode='Markdown')
         return
+    upload_queue.enqueue(call.message.chat.id)
+    outbox.send_message(call.message.chat.id, upload_queued, parse_mode='Markdown')
+
+
+def run_upload_job(job_id, user_id):
+    chat_id = int(user_id)
     try:
-        msg = bot.send_message(call.message.chat.id,
-                               uploading, parse_mode='Markdown')
-        uploader.process()
-        delete_files(user_path, call.message)
-        bot.delete_message(call.message.chat.id, msg.message_id)
-        bot.send_message(call.message.chat.id, upload_successful,
-                         reply_markup=universal_markup, parse_mode='Markdown')
+        uploader = open_session(chat_id)
+    except AuthError as e:
+        sessions.invalidate(chat_id)
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=login_markup, parse_mode='Markdown')
+        raise
     except Exception as e:
-        bot.delete_message(call.message.chat.id, msg.message_id)
-        bot.send_message(call.message.chat.id,
-                         upload_failed(e), parse_mode='Markdown')
+        # e.g. iBroadcast or the network failing during login; the user was promised a message
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=universal_markup, parse_mode='Markdown')
+        raise
+    if uploader is None:
+        outbox.send_message(chat_id, login_first,
+                            reply_markup=login_markup, parse_mode='Markdown')
+        return
+    uploader.load_files()
+    # Files already being uploaded by the receive pipeline are left to it
+    uploader.files = file_index.begin_upload(uploader.files)
+    if not uploader.files:
+        # Resumed job whose files were already uploaded or evicted
+        return
+    claimed = list(uploader.files)
+    outbox.status(chat_id, 'upload', uploading, parse_mode='Markdown')
+    progress = UploadProgress(lambda p: outbox.status(chat_id, 'upload', upload_progress(p), parse_mode='Markdown'),
+                              len(claimed), interval=progress_interval)
+    uploader.on_progress = progress
+    try:
+        uploader.known_md5 = file_index.md5s(user_id)
+        progress.start()
+        try:
+            uploader.prepare_upload()
+        finally:
+            # No progress edit may land after the final message
+            progress.stop()
+        # Only files upload() returned for, or that were already in the library
+        done = uploader.uploaded_files + uploader.skipped_files
+        for file_path in done:
+            if os.path.exists(file_path):
+                os.unlink(file_path)
+        file_index.mark_uploaded(done)
+        finished = set(done)
+        not_done = [f for f in claimed if f not in finished]
+        file_index.end_upload(not_done)
+        if not_done:
+            outbox.status(chat_id, 'upload', upload_failed(f"{len(not_done)} file(s) could not be uploaded"),
+                          reply_markup=universal_markup, parse_mode='Markdown')
+        else:
+            outbox.status(chat_id, 'upload', upload_successful,
+                          reply_markup=universal_markup, parse_mode='Markdown')
+    except AuthError as e:
+        file_index.end_upload(claimed)
+        sessions.invalidate(chat_id)
+        outbox.status(chat_id, 'upload', upload_failed(e),
+                      reply_markup=login_markup, parse_mode='Markdown')
+        raise
+    except Exception as e:
+        file_index.end_upload(claimed)
+        outbox.status(chat_id, 'upload', upload_failed(e), parse_mode='Markdown')
+        raise
+    finally:
+        outbox.end_status(chat_id, 'upload')
+
+
+def list_markup(page, pages):
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton(previous_page, callback_data=f"list:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(types.InlineKeyboardButton(next_page, callback_data=f"list:{page + 1}"))
+    if not buttons:
+        return None
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*buttons)
+    return markup
+
+
+def handle_list(call: telebot.types.CallbackQuery, page=None):
+    chat_id = call.message.chat.id
+    if not is_user_logged_in(chat_id):
+        outbox.send_message(chat_id, login_first,
+                            reply_markup=login_markup, parse_mode='Markdown')
+        return
+    # Served from the file index, so a page costs the same however long the list is
+    total, files = file_index.listing(chat_id, (page or 0) * list_page_size, list_page_size)
+    if not total:
+        outbox.send_message(chat_id, no_files, parse_mode='Markdown')
+        return
+    pages = (total + list_page_size - 1) // list_page_size
+    if page is not None and page >= pages:
+        # Files were uploaded since the page was shown
+        page = pages - 1
+        total, files = file_index.listing(chat_id, page * list_page_size, list_page_size)
+    text = file_list(files, (page or 0) * list_page_size, total, page or 0, pages)
+    if page is None:
+        outbox.send_message(chat_id, text, reply_markup=list_markup(0, pages), parse_mode='HTML')
+    else:
+        # Turning the page edits the list in place
+        outbox.edit_message_text(chat_id, call.message.message_id, text,
+                                 reply_markup=list_markup(page, pages), parse_mode='HTML')
 
 
-def handle_list(call: telebot.types.CallbackQuery):
-    global uploader, user_path
+def is_auto_upload(user_id):
+    return db.auto_upload(user_id)
+
+
+def handle_auto_upload(call: telebot.types.CallbackQuery):
     if not is_user_logged_in(call.message.chat.id):
-        bot.send_message(call.message.chat.id, login_first,
-                         reply_markup=login_markup, parse_mode='Markdown')
+        outbox.send_message(call.message.chat.id, login_first,
+                            reply_markup=login_markup, parse_mode='Markdown')
         return
-    files = os.listdir(user_path)
-    if not files:
-        bot.send_message(call.message.chat.id, no_files, parse_mode='Markdown')
-        return
-    files = [f"<blockquote>{i+1}. {file}</blockquote>" for i, file in enumerate(files)]
-    files_string = "\n".join(files)
-    bot.send_message(call.message.chat.id, "<b>📂 Files:</b>\n" +
-                     files_string, parse_mode='HTML')
+    enabled = not is_auto_upload(call.message.chat.id)
+    db.set_auto_upload(call.message.chat.id, enabled)
+    if enabled:
+        outbox.send_message(call.message.chat.id, auto_upload_on, parse_mode='Markdown')
+        # Pick up whatever is already waiting in the list
+        if list_user_files(create_user_directory(call.message.chat.id)):
+            upload_queue.enqueue(call.message.chat.id)
+    else:
+        # Files held back for the next batch stay in the list
+        batcher.discard(call.message.chat.id)
+        outbox.send_message(call.message.chat.id, auto_upload_off, parse_mode='Markdown')
 
 
 def handle_help(call: telebot.types.CallbackQuery):
-    bot.send_message(call.message.chat.id, welcome, parse_mode='Markdown')
+    outbox.send_message(call.message.chat.id, welcome, parse_mode='Markdown')
 
 
 @bot.message_handler(commands=['start'])
 def send_welcome(message: telebot.types.Message):
-    global uploader, user_path
     user_id = message.chat.id
-    user_path = os.path.join(dir_path, 'uploads', str(user_id))
-    create_user_directory(user_path)
+    create_user_directory(user_id)
     try:
         if is_user_logged_in(user_id):
-            bot.send_message(message.chat.id, welcome_back,
-                             reply_markup=universal_markup, parse_mode='Markdown')
+            outbox.send_message(message.chat.id, welcome_back,
+                                reply_markup=universal_markup, parse_mode='Markdown')
         else:
-            bot.send_message(message.chat.id, welcome,
-                             reply_markup=login_markup, parse_mode='Markdown')
+            outbox.send_message(message.chat.id, welcome,
+                                reply_markup=login_markup, parse_mode='Markdown')
     except sqlite3.Error as e:
-        bot.send_message(message.chat.id, database_error(e),
-                         parse_mode='Markdown')
+        outbox.send_message(message.chat.id, database_error(e),
+                            parse_mode='Markdown')
 
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -212,46 +371,171 @@ def callback_query(call: telebot.types.CallbackQuery):
     callback_data = call.data
     if callback_data in callback_handlers:
         callback_handlers[callback_data](call)
+    elif callback_data.startswith('list:'):
+        # The page buttons of the list carry the page to show
+        handle_list(call, int(callback_data[len('list:'):]))
     bot.answer_callback_query(call.id)
 
 
 @bot.message_handler(content_types=['audio', 'voice'])
 def save_audio(message: telebot.types.Message):
     if not is_user_logged_in(message.chat.id):
-        bot.send_message(message.chat.id, login_first,
-                         reply_markup=login_markup, parse_mode='Markdown')
+        outbox.send_message(message.chat.id, login_first,
+                            reply_markup=login_markup, parse_mode='Markdown')
         return
-    
-    folder_size = get_folder_size(user_path)
-    if folder_size > 100 * 1024 * 1024:
-        bot.send_message(message.chat.id, storage_limit,reply_markup=universal_markup, parse_mode='Markdown')
+    user_path = create_user_directory(message.chat.id)
+
+    if message.audio:
+        media = message.audio
+        title = message.audio.title if message.audio.title else f"audio_{message.audio.file_unique_id}"
+        sanitized_title = sanitize_filename(title)
+    elif message.voice:
+        media = message.voice
+        sanitized_title = sanitize_filename(
+            f"voice_message_{message.voice.file_unique_id}")
+    else:
         return
-    
+    file_path = os.path.join(user_path, f'{sanitized_title}.mp3')
 
-    sent_message = bot.reply_to(message, adding_to_list, parse_mode='Markdown')
     try:
-        if message.audio:
-            file_info = bot.get_file(message.audio.file_id)
-            title = message.audio.title if message.audio.title else f"audio_{message.audio.file_unique_id}"
-            sanitized_title = sanitize_filename(title)
-        elif message.voice:
-            file_info = bot.get_file(message.voice.file_id)
-            sanitized_title = sanitize_filename(
-                f"voice_message_{message.voice.file_unique_id}")
-        else:
-            return
-        downloaded_file = bot.download_file(file_info.file_path)
-        with open(os.path.join(user_path, f'{sanitized_title}.mp3'), 'wb') as new_file:
-            new_file.write(downloaded_file)
-        bot.delete_message(message.chat.id, sent_message.message_id)
-        bot.send_message(message.chat.id, added_to_list,
-                        reply_markup=universal_markup, parse_mode='Markdown')
-        
+        # Reserve the space up front so parallel messages cannot jointly exceed the limit
+        try:
+            status = file_index.claim(message.chat.id, media.file_unique_id, file_path,
+                                      size=media.file_size or 0, limit=storage_limit_bytes,
+                                      total_limit=spool.budget)
+        except PathTaken:
+            # Another track with the same title is still in the list
+            file_path = os.path.join(user_path, f'{sanitized_title}_{media.file_unique_id}.mp3')
+            status = file_index.claim(message.chat.id, media.file_unique_id, file_path,
+                                      size=media.file_size or 0, limit=storage_limit_bytes,
+                                      total_limit=spool.budget)
+    except SpoolFull:
+        outbox.send_message(message.chat.id, spool_full, reply_markup=universal_markup, parse_mode='Markdown')
+        return
+    except QuotaExceeded:
+        outbox.send_message(message.chat.id, storage_limit,reply_markup=universal_markup, parse_mode='Markdown')
+        return
+    if status == 'uploaded':
+        outbox.reply_to(message, already_uploaded, reply_markup=universal_markup, parse_mode='Markdown')
+        return
+    if status is not None:
+        outbox.reply_to(message, already_in_list, reply_markup=universal_markup, parse_mode='Markdown')
+        return
+
+    update_burst(message.chat.id, 'receive', adding_to_list, added_to_list, total=1)
+    # Blocks while the download stage is saturated, which holds back further updates
+    receive_pipeline.put((message, media, file_path))
+
+
+def download_stage(item):
+    message, media, file_path = item
+    try:
+        result = downloader.download(message, media, file_path)
+        file_index.add(message.chat.id, result.path, result.size, result.md5)
+        update_burst(message.chat.id, 'receive', adding_to_list, added_to_list, done=1)
+        return message.chat.id, result
+
     except telebot.apihelper.ApiTelegramException as e:
+        file_index.discard(file_path)
+        update_burst(message.chat.id, 'receive', adding_to_list, added_to_list, failed=1)
         if 'file is too big' in str(e):
-            bot.send_message(message.chat.id, "❌ The bot only accepts music files up to 20MB in size.", parse_mode='Markdown')
+            outbox.send_message(message.chat.id, "❌ The bot only accepts music files up to 20MB in size.", parse_mode='Markdown')
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ An error occurred:", parse_mode='Markdown')
+        file_index.discard(file_path)
+        update_burst(message.chat.id, 'receive', adding_to_list, added_to_list, failed=1)
+        outbox.send_message(message.chat.id, f"❌ An error occurred:", parse_mode='Markdown')
+
+
+def dedupe_stage(item):
+    chat_id, result = item
+    try:
+        uploader = open_session(chat_id)
+        if uploader is None:
+            return None
+        in_library = uploader.in_library(result.md5)
+    except AuthError as e:
+        sessions.invalidate(chat_id)
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=login_markup, parse_mode='Markdown')
+        return None
+    except Exception as e:
+        # The file stays in the list for the Upload button
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=universal_markup, parse_mode='Markdown')
+        return None
+    if in_library:
+        if file_index.begin_upload([result.path]):
+            if os.path.exists(result.path):
+                os.unlink(result.path)
+            file_index.mark_uploaded([result.path])
+            outbox.send_message(chat_id, already_uploaded, reply_markup=universal_markup, parse_mode='Markdown')
+        return None
+    if not is_auto_upload(chat_id):
+        # Waits in the list for the Upload button
+        return None
+    # Held back until the user's burst settles or the batch is full, see release_batch()
+    batcher.add(chat_id, (chat_id, uploader, result), result.size)
+    return None
+
+
+def release_batch(chat_id, items):
+    if not is_auto_upload(chat_id):
+        return
+    # Files the Upload button or eviction got to first are left alone
+    claimed = [item for item in items if file_index.begin_upload([item[2].path])]
+    if claimed:
+        update_burst(chat_id, 'auto', uploading_tracks, uploaded_tracks, total=len(claimed))
+    for item in claimed:
+        receive_pipeline.put(item, stage='upload')
+
+
+def upload_stage(item):
+    chat_id, uploader, result = item
+    uploader.file_md5[result.path] = result.md5
+    try:
+        uploader.upload(result.path)
+    except AuthError as e:
+        file_index.end_upload([result.path])
+        sessions.invalidate(chat_id)
+        update_burst(chat_id, 'auto', uploading_tracks, uploaded_tracks, failed=1)
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=login_markup, parse_mode='Markdown')
+        return
+    except Exception as e:
+        file_index.end_upload([result.path])
+        update_burst(chat_id, 'auto', uploading_tracks, uploaded_tracks, failed=1)
+        outbox.send_message(chat_id, upload_failed(e),
+                            reply_markup=universal_markup, parse_mode='Markdown')
+        return
+    if os.path.exists(result.path):
+        os.unlink(result.path)
+    file_index.mark_uploaded([result.path])
+    update_burst(chat_id, 'auto', uploading_tracks, uploaded_tracks, done=1)
+
+
+# (chat_id, key) -> [done, failed, total] of the files in the chat's current burst
+bursts = {}
+bursts_lock = threading.Lock()
+
+
+def update_burst(chat_id, key, progress, finished, done=0, failed=0, total=0):
+    """
+    Counts files through a burst and shows the counts in one status message per burst,
+    which is edited in place instead of sending a message for every file.
+    """
+    with bursts_lock:
+        counts = bursts.setdefault((chat_id, key), [0, 0, 0])
+        counts[0] += done
+        counts[1] += failed
+        counts[2] += total
+        done, failed, total = counts
+        # Queued under the lock, so the edits reach the chat in order
+        if done + failed < total:
+            outbox.status(chat_id, key, progress(done, total), parse_mode='Markdown')
+            return
+        del bursts[(chat_id, key)]
+        outbox.status(chat_id, key, finished(done, total), reply_markup=universal_markup, parse_mode='Markdown')
+        outbox.end_status(chat_id, key)
 
 
 callback_handlers = {
@@ -259,12 +543,129 @@ callback_handlers = {
     "logout": handle_logout,
     "upload": handle_upload,
     "list": handle_list,
+    "auto": handle_auto_upload,
     "help": handle_help
 }
 
-while True:
-    try:
-        bot.polling(none_stop=True)
-    except Exception as e:
-        print(f"Bot polling failed, restarting in 5 seconds. Error:\n{e}")
-        time.sleep(5)
\ No newline at end of file
+def report_pipeline_error(stage, item, error):
+    pipeline_errors.inc(stage, type(error).__name__)
+    traceback.print_exception(error)
+
+
+def notify_evicted(user_id, names):
+    outbox.send_message(int(user_id), files_evicted(len(names), spool_max_age // (60 * 60)),
+                        reply_markup=universal_markup, parse_mode='Markdown')
+
+
+upload_queue = JobQueue(db, run_upload_job, workers=upload_workers, owns=owns_user)
+# Every received file flows through download -> dedupe -> upload on its own; the hash is
+# computed while downloading. Only files of users with auto upload on reach the upload stage,
+# in batches released by the batcher.
+receive_pipeline = Pipeline([
+    Stage('download', download_stage, int(os.getenv('DOWNLOAD_WORKERS', 4))),
+    Stage('dedupe', dedupe_stage, 2),
+    # Upload workers wait on the shared limiter, which decides how many uploads are in flight
+    Stage('upload', upload_stage, upload_limiter.max_limit),
+], maxsize=16, on_error=report_pipeline_error)
+batcher = UploadBatcher(release_batch,
+                        idle=int(os.getenv('AUTO_UPLOAD_IDLE_SECONDS', 20)),
+                        max_files=int(os.getenv('AUTO_UPLOAD_MAX_FILES', 10)),
+                        max_bytes=int(os.getenv('AUTO_UPLOAD_MAX_MB', 50)) * 1024 * 1024)
+spool = SpoolManager(os.path.join(dir_path, 'uploads'), file_index, spool_budget_bytes, spool_max_age,
+                     on_evict=notify_evicted, owns=owns_user)
+
+metrics.add(Gauge('ibroadcast_bot_queue_depth', 'Items waiting in the bot\'s queues',
+                  lambda: {**{(stage.name,): depth for stage, depth in zip(receive_pipeline.stages, receive_pipeline.depth())},
+                           ('batched',): batcher.pending(), ('jobs',): upload_queue.pending(),
+                           ('outbox',): outbox.pending()},
+                  ('queue',)))
+metrics.add(Gauge('ibroadcast_bot_spool_bytes', 'Bytes reserved or stored in the spool', spool.used))
+metrics.add(Gauge('ibroadcast_bot_upload_limit', 'Uploads the adaptive limiter currently allows at once',
+                  lambda: upload_limiter.limit))
+metrics.add(Gauge('ibroadcast_bot_uploads_in_flight', 'Uploads currently in flight', lambda: upload_limiter.in_flight))
+
+
+def run_polling():
+    bot.remove_webhook()
+    while True:
+        try:
+            bot.polling(none_stop=True)
+        except Exception as e:
+            print(f"Bot polling failed, restarting in 5 seconds. Error:\n{e}")
+            time.sleep(5)
+
+
+def run_webhook(target=bot, workers=handler_threads, max_connections=None):
+    secret_token = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+    server = WebhookServer(target, host=os.getenv('WEBHOOK_LISTEN', '0.0.0.0'),
+                           port=int(os.getenv('WEBHOOK_PORT', 8443)),
+                           path=urlparse(webhook_url).path or '/', secret_token=secret_token,
+                           workers=workers,
+                           certfile=os.getenv('WEBHOOK_CERT'), keyfile=os.getenv('WEBHOOK_KEY'))
+    bot.remove_webhook()
+    if os.getenv('WEBHOOK_CERT'):
+        # Self-signed certificates have to be uploaded along with the webhook
+        with open(os.getenv('WEBHOOK_CERT'), 'rb') as certificate:
+            bot.set_webhook(url=webhook_url, secret_token=secret_token, certificate=certificate,
+                            max_connections=max_connections)
+    else:
+        bot.set_webhook(url=webhook_url, secret_token=secret_token, max_connections=max_connections)
+    print(f"Listening for webhook updates on port {server.port}")
+    server.serve_forever()
+
+
+def start_services():
+    file_index.recover(owns=owns_user)
+    upload_queue.recover()
+    waiting = spool.reconcile()
+    for user_id in waiting:
+        # Auto uploads the previous run did not finish, including ones cut off mid-upload
+        if db.auto_upload(user_id):
+            upload_queue.enqueue(user_id)
+    print(f"Spool: {spool.used()} bytes pending for {len(waiting)} user(s), "
+          f"{upload_queue.pending()} upload job(s) to resume")
+    if os.getenv('METRICS_PORT'):
+        # Worker processes serve theirs on the following ports
+        metrics.serve(os.getenv('METRICS_LISTEN', '127.0.0.1'), int(os.getenv('METRICS_PORT')) + (shard_index or 0))
+    outbox.start()
+    spool.start()
+    upload_queue.start()
+    receive_pipeline.start()
+    batcher.start()
+
+
+def run_shard(updates):
+    """
+    Entry point of a worker process started by the dispatcher.
+    """
+    start_services()
+    serve(bot, updates, lanes=handler_threads)
+
+
+def run_dispatcher():
+    dispatcher = Dispatcher(run_shard, worker_processes)
+    dispatcher.start()
+    print(f"Dispatching updates to {worker_processes} worker processes")
+    if webhook_url:
+        # Telegram sends updates over several connections at once by default, which can
+        # reorder a chat's updates. With one connection each update is forwarded before the
+        # next one is sent.
+        run_webhook(dispatcher, workers=1, max_connections=1)
+    else:
+        bot.remove_webhook()
+        dispatcher.poll(bot)
+
+
+def main():
+    if worker_processes > 1:
+        run_dispatcher()
+        return
+    start_services()
+    if webhook_url:
+        run_webhook()
+    else:
+        run_polling()
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,138 @@
+# cluster.py
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+# Update fields that carry a chat, in the order they are looked at
+CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member',
+               'chat_member', 'chat_join_request')
+
+
+class HashRing:
+    """
+    Consistent hash ring over worker indexes. Every worker is placed at `replicas` points
+    on the ring, so keys spread evenly and a key always maps to the same worker.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        ring = sorted((self._hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._keys = [key for key, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+    def node(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+def chat_id(update):
+    """
+    Returns the id of the chat an update belongs to, or None for updates without one.
+    """
+    for field in CHAT_FIELDS:
+        item = getattr(update, field, None)
+        if item is not None:
+            return item.chat.id
+    call = getattr(update, 'callback_query', None)
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    return None
+
+
+class Dispatcher:
+    """
+    Receives updates in the main process and forwards each to the worker process that
+    owns its chat. Updates of one chat always go to the same worker through the same
+    queue, so they are handled in the order they arrived. Workers that die are restarted.
+    """
+
+    def __init__(self, target, processes, queue_size=1000):
+        self.target = target
+        self.ring = HashRing(range(processes))
+        # Workers import the bot afresh instead of inheriting the dispatcher's threads
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue(queue_size) for _ in range(processes)]
+        self.processes = [None] * processes
+
+    def start(self):
+        for index in range(len(self.processes)):
+            self._spawn(index)
+        threading.Thread(target=self._supervise, name='supervisor', daemon=True).start()
+
+    def _spawn(self, index):
+        process = self._context.Process(target=self.target, args=(self.queues[index],),
+                                        name=f'worker-{index}', daemon=True)
+        # Read by the worker while it imports the bot, before `target` is called
+        os.environ['SHARD_INDEX'] = str(index)
+        try:
+            process.start()
+        finally:
+            del os.environ['SHARD_INDEX']
+        self.processes[index] = process
+
+    def _supervise(self, interval=5):
+        while True:
+            time.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                    self._spawn(index)
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            key = chat_id(update)
+            # Blocks while the worker's queue is full, which holds back polling
+            self.queues[self.ring.node(key if key is not None else 0)].put(update)
+
+    def poll(self, bot, timeout=20):
+        offset = None
+        while True:
+            try:
+                updates = bot.get_updates(offset=offset, timeout=timeout, long_polling_timeout=timeout)
+            except Exception as e:
+                print(f"Bot polling failed, retrying in 5 seconds. Error:\n{e}")
+                time.sleep(5)
+                continue
+            if updates:
+                offset = updates[-1].update_id + 1
+                self.process_new_updates(updates)
+
+
+def serve(bot, updates, lanes=4):
+    """
+    Runs a worker's handlers on `lanes` threads. A chat is always handled on the same
+    lane, one update after another. Returns once the dispatcher process is gone.
+    """
+    queues = [queue.Queue() for _ in range(lanes)]
+
+    def work(lane):
+        while True:
+            update = lane.get()
+            try:
+                bot.process_new_updates([update])
+            except Exception:
+                traceback.print_exc()
+
+    for i, lane in enumerate(queues):
+        threading.Thread(target=work, args=(lane,), name=f'handler-{i}', daemon=True).start()
+
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            update = updates.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                return
+            continue
+        key = chat_id(update)
+        queues[(key or 0) % lanes].put(update)
+
@@ -0,0 +1,136 @@
+# db.py
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users
+    (user_id TEXT PRIMARY KEY,
+    login_token TEXT,
+    state TEXT DEFAULT 'logout',
+    first_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_login TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_logout TIMESTAMP,
+    auto_upload INTEGER DEFAULT 0);
+
+    CREATE TABLE IF NOT EXISTS files
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT,
+    size INTEGER,
+    md5 TEXT,
+    status TEXT DEFAULT 'pending',
+    received TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    file_unique_id TEXT);
+
+    CREATE TABLE IF NOT EXISTS usage
+    (user_id TEXT PRIMARY KEY,
+    bytes INTEGER DEFAULT 0,
+    files INTEGER DEFAULT 0);
+
+    CREATE TABLE IF NOT EXISTS jobs
+    (id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    state TEXT DEFAULT 'pending',
+    error TEXT,
+    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started TIMESTAMP,
+    finished TIMESTAMP);
+'''
+
+# Columns added after the tables were first created: (table, column, definition)
+MIGRATIONS = [
+    ('users', 'auto_upload', 'INTEGER DEFAULT 0'),
+    ('files', 'file_unique_id', 'TEXT'),
+]
+
+INDEXES = '''
+    CREATE INDEX IF NOT EXISTS users_state ON users (state);
+    CREATE INDEX IF NOT EXISTS files_user_status ON files (user_id, status);
+    CREATE INDEX IF NOT EXISTS files_unique_id ON files (user_id, file_unique_id);
+    CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, user_id);
+'''
+
+
+class Database:
+    """
+    The bot's SQLite database. Every thread gets its own connection, and the database runs
+    in WAL mode, so readers never wait on a writer and handlers do not share a cursor.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        with self.transaction() as conn:
+            # executescript() would commit the transaction, so statements run one by one
+            for statement in SCHEMA.split(';'):
+                conn.execute(statement)
+            for table, column, definition in MIGRATIONS:
+                if column not in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            for statement in INDEXES.split(';'):
+                conn.execute(statement)
+
+    def connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit, transactions are opened explicitly by transaction()
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            # Durable across application crashes; only a power loss can drop the last commits
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA cache_size = -8000")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connect().execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a write transaction. It takes the write lock up front, so two
+        transactions never deadlock upgrading a read lock.
+        """
+        conn = self.connect()
+        if conn.in_transaction:
+            # Nested in an outer transaction of this thread
+            yield conn
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def log_in(self, user_id, login_token):
+        self.execute('''
+            INSERT INTO users (user_id, login_token, state) VALUES (?, ?, 'login')
+            ON CONFLICT (user_id) DO UPDATE SET
+                login_token = excluded.login_token, state = 'login', last_login = CURRENT_TIMESTAMP
+        ''', (str(user_id), login_token))
+
+    def log_out(self, user_id):
+        self.execute("UPDATE users SET state = 'logout', last_logout = CURRENT_TIMESTAMP WHERE user_id = ?",
+                     (str(user_id),))
+
+    def login_token(self, user_id):
+        """
+        Returns the login token of a logged in user, or None.
+        """
+        row = self.execute("SELECT login_token FROM users WHERE user_id = ? AND state = 'login'",
+                           (str(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def auto_upload(self, user_id):
+        row = self.execute("SELECT auto_upload FROM users WHERE user_id = ?", (str(user_id),)).fetchone()
+        return bool(row and row[0])
+
+    def set_auto_upload(self, user_id, enabled):
+        self.execute("UPDATE users SET auto_upload = ? WHERE user_id = ?", (int(enabled), str(user_id)))
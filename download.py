@@ -0,0 +1,166 @@
+# download.py
+
+import os
+import math
+import asyncio
+import hashlib
+import tempfile
+import threading
+import requests
+from collections import namedtuple
+from telebot import apihelper
+from metrics import timed
+
+DownloadResult = namedtuple('DownloadResult', ['path', 'size', 'md5'])
+
+
+class BotApiDownloader:
+    """
+    Downloads Telegram files through the Bot API, streaming them to disk in chunks
+    and hashing them on the way.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, bot, chunk_size=CHUNK_SIZE, timeout=60):
+        self.bot = bot
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.observe = None
+
+    def file_url(self, file_path):
+        if apihelper.FILE_URL is None:
+            return f"https://api.telegram.org/file/bot{self.bot.token}/{file_path}"
+        return apihelper.FILE_URL.format(self.bot.token, file_path)
+
+    @timed('telegram_get_file')
+    def get_file(self, media):
+        return self.bot.get_file(media.file_id)
+
+    @timed('telegram_download')
+    def download(self, message, media, destination):
+        file_info = self.get_file(media)
+        url = self.file_url(file_info.file_path)
+
+        # Dot-prefixed so the partial file is ignored by Uploader.load_files
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(destination))
+        size = 0
+        md5 = hashlib.md5()
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                with self.session.get(url, stream=True, timeout=self.timeout, proxies=apihelper.proxy) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(self.chunk_size):
+                        temp_file.write(chunk)
+                        md5.update(chunk)
+                        size += len(chunk)
+            os.replace(temp_path, destination)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return DownloadResult(destination, size, md5.hexdigest())
+
+
+class MTProtoDownloader:
+    """
+    Downloads Telegram files over MTProto with Pyrogram, which is not bound by the 20 MB
+    limit of the Bot API. Large files are split into ranges streamed at the same time.
+    """
+
+    # MTProto serves files in fixed 1 MiB chunks, ranges are counted in those
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, bot, api_id, api_hash, workdir, parts_per_file=4, max_parts=8, min_part_size=8 * 1024 * 1024,
+                 timeout=60 * 60, name='mtproto_downloader'):
+        import pyrogram
+
+        self.bot = bot
+        self.observe = None
+        self.parts_per_file = parts_per_file
+        self.min_part_size = min_part_size
+        self.timeout = timeout
+        self.client = None
+        self._client_lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='mtproto', daemon=True).start()
+
+        async def start():
+            # The client binds to the loop it is created on, so it has to be created in it
+            client = pyrogram.Client(name, api_id=api_id, api_hash=api_hash,
+                                     bot_token=bot.token, workdir=workdir, no_updates=True,
+                                     max_concurrent_transmissions=max_parts)
+            await client.start()
+            return client
+
+        self._start = start
+
+    def connect(self):
+        # Connected on first use, so processes that never download do not hold a session
+        with self._client_lock:
+            if self.client is None:
+                self.client = self._run(self._start())
+        return self.client
+
+    def _run(self, coroutine):
+        # The timeout is applied in the loop, so a timed out download is cancelled before returning
+        return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coroutine, self.timeout), self._loop).result()
+
+    def ranges(self, size):
+        """
+        Splits a file of `size` bytes into (offset, limit) ranges of whole chunks.
+        """
+        chunks = max(math.ceil(size / self.CHUNK_SIZE), 1)
+        parts = max(min(self.parts_per_file, size // self.min_part_size), 1)
+        per_part = math.ceil(chunks / parts)
+        return [(offset, min(per_part, chunks - offset)) for offset in range(0, chunks, per_part)]
+
+    async def _fetch(self, file_id, fd, offset, limit):
+        position = offset * self.CHUNK_SIZE
+        async for chunk in self.client.stream_media(file_id, limit=limit, offset=offset):
+            os.pwrite(fd, chunk, position)
+            position += len(chunk)
+
+    async def _download(self, file_id, size, fd):
+        if not size:
+            # Unknown size, stream it all in one go
+            return await self._fetch(file_id, fd, 0, 0)
+        tasks = [asyncio.ensure_future(self._fetch(file_id, fd, offset, limit)) for offset, limit in self.ranges(size)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Nothing may write to the file once the caller closes it
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    @timed('telegram_download')
+    def download(self, message, media, destination):
+        # Dot-prefixed so the partial file is ignored by Uploader.load_files
+        fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=os.path.dirname(destination))
+        try:
+            try:
+                self.connect()
+                self._run(self._download(media.file_id, media.file_size or 0, fd))
+            finally:
+                os.close(fd)
+            # Ranges arrive out of order, so the file is hashed once it is complete
+            size = 0
+            md5 = hashlib.md5()
+            with open(temp_path, 'rb') as temp_file:
+                for chunk in iter(lambda: temp_file.read(self.CHUNK_SIZE), b''):
+                    md5.update(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, destination)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        return DownloadResult(destination, size, md5.hexdigest())
+
+    def stop(self):
+        if self.client is not None:
+            self._run(self.client.stop())
+        self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,191 @@
+# file_index.py
+
+import os
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class SpoolFull(QuotaExceeded):
+    pass
+
+
+class PathTaken(Exception):
+    pass
+
+
+class FileIndex:
+    """
+    Per-user index of received files, with the size and MD5 computed while downloading.
+    Also keeps a per-user byte and file counter of what is reserved or stored on disk.
+    """
+
+    # Statuses of files that take up (or will take up) space in the user's directory
+    STORED = ('receiving', 'pending', 'uploading')
+
+    def __init__(self, db):
+        self.db = db
+
+    def recover(self, owns=None):
+        """
+        Resets the files that were in flight when the process died, only those of users
+        for which `owns` returns True if it is set.
+        """
+        with self.db.transaction() as conn:
+            rows = conn.execute("SELECT user_id, path, status FROM files WHERE status IN ('receiving', 'uploading')")
+            for user_id, path, status in rows.fetchall():
+                if owns is not None and not owns(user_id):
+                    continue
+                if status == 'receiving':
+                    # The download never finished
+                    conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                else:
+                    conn.execute("UPDATE files SET status = 'pending' WHERE path = ?", (path,))
+            self._recount(conn)
+
+    def _recount(self, conn):
+        conn.execute("DELETE FROM usage")
+        conn.execute('''
+            INSERT INTO usage (user_id, bytes, files)
+            SELECT user_id, COALESCE(SUM(size), 0), COUNT(*) FROM files
+            WHERE status IN ('receiving', 'pending', 'uploading')
+            GROUP BY user_id
+        ''')
+
+    def _adjust(self, conn, user_id, size, files):
+        conn.execute('''
+            INSERT INTO usage (user_id, bytes, files) VALUES (?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET bytes = bytes + excluded.bytes, files = files + excluded.files
+        ''', (user_id, size, files))
+
+    def _release(self, conn, path):
+        row = conn.execute("SELECT user_id, size, status FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[2] in self.STORED:
+            self._adjust(conn, row[0], -(row[1] or 0), -1)
+
+    def usage(self, user_id):
+        row = self.db.execute("SELECT bytes, files FROM usage WHERE user_id = ?", (str(user_id),)).fetchone()
+        return row or (0, 0)
+
+    def total_usage(self):
+        return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM usage").fetchone()[0]
+
+    def pending(self):
+        return self.db.execute("SELECT user_id, path FROM files WHERE status = 'pending'").fetchall()
+
+    def listing(self, user_id, offset=0, limit=10):
+        """
+        Returns how many files the user has in the list, and the name, size, received time
+        and status of `limit` of them from `offset` on, oldest first.
+        """
+        user_id = str(user_id)
+        count = self.db.execute(
+            "SELECT COUNT(*) FROM files WHERE user_id = ? AND status IN ('pending', 'uploading')",
+            (user_id,)).fetchone()[0]
+        rows = self.db.execute('''
+            SELECT name, size, received, status FROM files WHERE user_id = ? AND status IN ('pending', 'uploading')
+            ORDER BY id LIMIT ? OFFSET ?
+        ''', (user_id, limit, offset)).fetchall()
+        return count, rows
+
+    def stale(self, max_age):
+        return self.db.execute(
+            "SELECT user_id, path FROM files WHERE status = 'pending' AND received < datetime('now', ?)",
+            (f'-{int(max_age)} seconds',)).fetchall()
+
+    def claim(self, user_id, file_unique_id, path, size=0, limit=None, total_limit=None):
+        """
+        Returns the status of an already known file with this `file_unique_id`, or
+        reserves `size` bytes for `path` and records it as being received.
+        Raises QuotaExceeded if the reservation would take the user over `limit`,
+        or SpoolFull if it would take all users together over `total_limit`.
+        Raises PathTaken if a different file is still received or waiting at `path`.
+        """
+        user_id = str(user_id)
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT id, path, status FROM files WHERE user_id = ? AND file_unique_id = ? ORDER BY id DESC LIMIT 1",
+                (user_id, file_unique_id)).fetchone()
+            if row and (row[2] != 'pending' or os.path.exists(row[1])):
+                return row[2]
+            taken = conn.execute("SELECT status, file_unique_id FROM files WHERE path = ?", (path,)).fetchone()
+            if taken and taken[0] in self.STORED and taken[1] != file_unique_id:
+                raise PathTaken(path)
+            if limit is not None:
+                used = conn.execute("SELECT bytes FROM usage WHERE user_id = ?", (user_id,)).fetchone()
+                if (used[0] if used else 0) + size > limit:
+                    raise QuotaExceeded(f'{user_id} would exceed {limit} bytes')
+            if total_limit is not None:
+                used = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM usage").fetchone()
+                if used[0] + size > total_limit:
+                    raise SpoolFull(f'Spool would exceed {total_limit} bytes')
+            self._release(conn, path)
+            conn.execute('''
+                INSERT INTO files (user_id, path, name, size, status, file_unique_id) VALUES (?, ?, ?, ?, 'receiving', ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size, md5 = NULL, status = 'receiving', file_unique_id = excluded.file_unique_id
+            ''', (user_id, path, os.path.basename(path), size, file_unique_id))
+            self._adjust(conn, user_id, size, 1)
+        return None
+
+    def discard(self, path):
+        with self.db.transaction() as conn:
+            self._release(conn, path)
+            conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def evict(self, path):
+        """
+        Removes a file from the index if it is still pending, and returns whether it was.
+        A file an upload has already claimed is left alone.
+        """
+        with self.db.transaction() as conn:
+            # The write lock is held from here on, so no upload can claim the file in between
+            row = conn.execute("SELECT status FROM files WHERE path = ?", (path,)).fetchone()
+            if not row or row[0] != 'pending':
+                return False
+            self._release(conn, path)
+            conn.execute("DELETE FROM files WHERE path = ?", (path,))
+        return True
+
+    def add(self, user_id, path, size, md5):
+        user_id = str(user_id)
+        with self.db.transaction() as conn:
+            self._release(conn, path)
+            conn.execute('''
+                INSERT INTO files (user_id, path, name, size, md5) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size, md5 = excluded.md5, status = 'pending', received = CURRENT_TIMESTAMP
+            ''', (user_id, path, os.path.basename(path), size, md5))
+            self._adjust(conn, user_id, size, 1)
+
+    def md5s(self, user_id):
+        rows = self.db.execute(
+            "SELECT path, md5 FROM files WHERE user_id = ? AND status IN ('pending', 'uploading')",
+            (str(user_id),)).fetchall()
+        return {path: md5 for path, md5 in rows if md5}
+
+    def begin_upload(self, paths):
+        """
+        Moves pending files to 'uploading' and returns the ones that were moved, so the
+        same file is never picked up by two uploads at once.
+        """
+        started = []
+        with self.db.transaction() as conn:
+            for path in paths:
+                cursor = conn.execute(
+                    "UPDATE files SET status = 'uploading' WHERE path = ? AND status = 'pending'", (path,))
+                if cursor.rowcount:
+                    started.append(path)
+        return started
+
+    def end_upload(self, paths):
+        with self.db.transaction() as conn:
+            conn.executemany("UPDATE files SET status = 'pending' WHERE path = ? AND status = 'uploading'",
+                             [(path,) for path in paths])
+
+    def mark_uploaded(self, paths):
+        with self.db.transaction() as conn:
+            for path in paths:
+                self._release(conn, path)
+                conn.execute("UPDATE files SET status = 'uploaded' WHERE path = ?", (path,))
@@ -0,0 +1,104 @@
+# jobs.py
+
+import threading
+import traceback
+
+
+class JobQueue:
+    """
+    Persistent upload job queue stored in SQLite and drained by a pool of worker threads.
+    Pending jobs are handed out round-robin across users, with at most one running job per user.
+    With `owns` set, only jobs of users for which it returns True are taken.
+    """
+
+    def __init__(self, db, handler, workers=3, owns=None):
+        self.db = db
+        self.handler = handler
+        self.workers = workers
+        self.owns = owns
+        self._lock = threading.Condition()
+        self._running_users = set()
+        self._last_served = {}
+        self._turn = 0
+        self._threads = []
+
+    def recover(self):
+        # Jobs that were running when the process died are picked up again
+        with self.db.transaction() as conn:
+            for job_id, user_id in conn.execute("SELECT id, user_id FROM jobs WHERE state = 'running'").fetchall():
+                if self.owns is None or self.owns(user_id):
+                    conn.execute("UPDATE jobs SET state = 'pending', started = NULL WHERE id = ?", (job_id,))
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'upload-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            row = self.db.execute(
+                "SELECT id FROM jobs WHERE user_id = ? AND state = 'pending'", (user_id,)).fetchone()
+            if row:
+                # A pending job uploads everything in the user's directory, so one is enough
+                return row[0]
+            cursor = self.db.execute("INSERT INTO jobs (user_id) VALUES (?)", (user_id,))
+            self._lock.notify()
+            return cursor.lastrowid
+
+    def pending(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                row = self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'").fetchone()
+            else:
+                row = self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending' AND user_id = ?",
+                                      (str(user_id),)).fetchone()
+            return row[0]
+
+    def is_running(self, user_id):
+        with self._lock:
+            return str(user_id) in self._running_users
+
+    def _next_job(self):
+        rows = self.db.execute("SELECT id, user_id FROM jobs WHERE state = 'pending' ORDER BY id").fetchall()
+        candidates = {}
+        for job_id, user_id in rows:
+            if user_id in self._running_users or user_id in candidates:
+                continue
+            if self.owns is None or self.owns(user_id):
+                candidates[user_id] = job_id
+        if not candidates:
+            return None
+
+        # Serve the user that has waited the longest since its last turn
+        user_id = min(candidates, key=lambda u: (self._last_served.get(u, 0), candidates[u]))
+        job_id = candidates[user_id]
+        self._turn += 1
+        self._last_served[user_id] = self._turn
+        self._running_users.add(user_id)
+        self.db.execute("UPDATE jobs SET state = 'running', started = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+        return job_id, user_id
+
+    def _finish(self, job_id, user_id, error=None):
+        with self._lock:
+            self.db.execute("UPDATE jobs SET state = ?, error = ?, finished = CURRENT_TIMESTAMP WHERE id = ?",
+                            ('failed' if error else 'done', error, job_id))
+            self._running_users.discard(user_id)
+            self._lock.notify_all()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None:
+                    self._lock.wait()
+                    job = self._next_job()
+            job_id, user_id = job
+            try:
+                self.handler(job_id, user_id)
+            except Exception as e:
+                traceback.print_exc()
+                self._finish(job_id, user_id, str(e))
+            else:
+                self._finish(job_id, user_id)
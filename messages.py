@@ -1,5 +1,7 @@
 # messages.py
 
+from html import escape
+
 # Login successful message
 login_successful = "*🎉 Login successful*"
 
@@ -18,6 +20,18 @@ logout_successful = "*👋 Good Bye.Logout successful*"
 # Uploading message
 uploading = "*⏳ Uploading... Please wait.*"
 
+def upload_progress(progress):
+    text = f"*⏳ Uploading... {progress.done + progress.skipped}/{progress.total} done*"
+    if progress.failed:
+        text += f"\n❌ {progress.failed} failed"
+    if progress.size:
+        percent = int(100 * progress.sent / progress.size)
+        text += f"\n`[{'█' * (percent // 10)}{'░' * (10 - percent // 10)}] {percent}%` of the tracks in flight"
+    return text
+
+# Upload queued message
+upload_queued = "*📤 Upload queued. You will get a message once it is done.*"
+
 # Upload successful message
 upload_successful = "*✅ Upload successful*"
 
@@ -29,6 +43,20 @@ no_files = "*📂 No files found.*"
 
 empty_list = "📂 List is empty. You can add music by *sending them.*"
 
+# One page of the list, in HTML; `files` are (name, size, received, status) rows
+def file_list(files, start, total, page, pages):
+    lines = [f"<b>📂 Files: {total}</b> (page {page + 1}/{pages})"]
+    for i, (name, size, received, status) in enumerate(files, start + 1):
+        line = f"{i}. {escape(name[:100])} · {(size or 0) / (1024 * 1024):.1f} MB · {(received or '')[:16]}"
+        if status == 'uploading':
+            line += " · ⏳ uploading"
+        lines.append(f"<blockquote>{line}</blockquote>")
+    return "\n".join(lines)
+
+previous_page = "« Prev"
+
+next_page = "Next »"
+
 # Welcome back message
 welcome_back = "*👋 Welcome back!*"
 
@@ -53,10 +81,38 @@ to show up the menu use /start 💫
 """
 
 # Adding to the list message
-adding_to_list = "*🎵 Adding to the list...*"
+def adding_to_list(added, total):
+    return f"*🎵 Adding to the list... {added}/{total} added*"
 
 # Successfully added to the list message
-added_to_list = "*✅ Successfully added to the list.*"
+def added_to_list(added, total):
+    if added == total:
+        return f"*✅ Successfully added {added} track(s) to the list.*"
+    return f"*✅ Added {added} of {total} track(s) to the list.*"
+
+# Duplicate track messages
+already_in_list = "*📂 This track is already in your list.*"
+
+already_uploaded = "*✅ This track was already uploaded.*"
+
+# Auto upload messages
+auto_upload_on = "*⚡ Auto upload is on.* Tracks you send are uploaded shortly after they arrive."
+
+auto_upload_off = "*⏸ Auto upload is off.* Press Upload to send your list."
+
+def uploading_tracks(uploaded, total):
+    return f"*⏳ Uploading... {uploaded}/{total} uploaded*"
+
+def uploaded_tracks(uploaded, total):
+    if uploaded == total:
+        return f"*✅ Uploaded {uploaded} track(s).*"
+    return f"*✅ Uploaded {uploaded} of {total} track(s).*"
+
+# Spool messages
+spool_full = "*⏳ The bot is out of space right now. Please try again after a while.*"
+
+def files_evicted(count, hours):
+    return f"*🗑 {count} file(s) were removed because they were not uploaded within {hours} hours.*"
 
 # Storage kimit
 storage_limit = "❗ Your storage exceeds *100MB*. Please upload the music before sending new ones."
\ No newline at end of file
@@ -0,0 +1,224 @@
+# outbox.py
+
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from telebot import apihelper
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def delay(self, now):
+        """
+        Returns how many seconds to wait before a token is available.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        self.paused_until = time.monotonic() + seconds
+
+    def idle(self, now):
+        return now >= self.paused_until and self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+class _Call:
+    def __init__(self, method, args, kwargs):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+    def run(self, bot):
+        self.future.set_result(getattr(bot, self.method)(*self.args, **self.kwargs))
+
+    def fail(self, e):
+        self.future.set_exception(e)
+
+
+class _Status:
+    """
+    A status message that is sent once and then edited in place. Updates made while it
+    waits in the queue replace each other, so only the latest text reaches Telegram.
+    """
+
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.message_id = None
+        self.text = None
+        self.kwargs = {}
+        self.queued = False
+        self.future = Future()
+        self._lock = threading.Lock()
+
+    def update(self, text, kwargs):
+        """
+        Returns True if the status has to be queued again.
+        """
+        with self._lock:
+            self.text = text
+            self.kwargs = kwargs
+            queue = not self.queued
+            self.queued = True
+        return queue
+
+    def run(self, bot):
+        with self._lock:
+            text, kwargs = self.text, self.kwargs
+            self.queued = False
+        if self.message_id is None:
+            self.message_id = bot.send_message(self.chat_id, text, **kwargs).message_id
+            self.future.set_result(self.message_id)
+            return
+        try:
+            bot.edit_message_text(text, self.chat_id, self.message_id, **kwargs)
+        except apihelper.ApiTelegramException as e:
+            if 'message is not modified' not in str(e):
+                raise
+
+    def fail(self, e):
+        if not self.future.done():
+            self.future.set_exception(e)
+
+
+class Outbox:
+    """
+    Sends outgoing Telegram messages from a few background threads, so handlers never wait
+    on Telegram. Each chat and the bot as a whole get a token bucket to stay under the flood
+    limits; a 429 pauses the chat for as long as Telegram asks. Messages to a chat are sent
+    in the order they were queued.
+    """
+
+    def __init__(self, bot, chat_rate=1, chat_burst=3, global_rate=25, workers=4):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._buckets = {}
+        self._busy = set()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._status = {}
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'outbox-{i}', daemon=True).start()
+        return self
+
+    def pending(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _submit(self, chat_id, op):
+        with self._cond:
+            self._queues.setdefault(chat_id, deque()).append(op)
+            self._cond.notify()
+        return op.future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._submit(chat_id, _Call('send_message', (chat_id, text), kwargs))
+
+    def reply_to(self, message, text, **kwargs):
+        return self._submit(message.chat.id, _Call('reply_to', (message, text), kwargs))
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        return self._submit(chat_id, _Call('edit_message_text', (text, chat_id, message_id), kwargs))
+
+    def delete_message(self, chat_id, message_id):
+        return self._submit(chat_id, _Call('delete_message', (chat_id, message_id), {}))
+
+    def status(self, chat_id, key, text, **kwargs):
+        """
+        Shows `text` in the chat's `key` status message, sending it the first time and
+        editing it afterwards. Returns a future of the message id.
+        """
+        with self._cond:
+            status = self._status.get((chat_id, key))
+            if status is None:
+                status = self._status[(chat_id, key)] = _Status(chat_id)
+        if status.update(text, kwargs):
+            self._submit(chat_id, status)
+        return status.future
+
+    def end_status(self, chat_id, key):
+        """
+        Leaves the status message as it is; the next status() call sends a new one.
+        """
+        with self._cond:
+            self._status.pop((chat_id, key), None)
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {key: value for key, value in self._buckets.items()
+                                 if key in self._queues or not value.idle(now)}
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._global.delay(now)
+                if wait == 0:
+                    wait = None
+                    for chat_id, queue in self._queues.items():
+                        if chat_id in self._busy:
+                            continue
+                        delay = self._bucket(chat_id, now).delay(now)
+                        if delay == 0:
+                            break
+                        wait = delay if wait is None else min(wait, delay)
+                    else:
+                        self._cond.wait(wait)
+                        continue
+                    self._buckets[chat_id].take()
+                    self._global.take()
+                    self._busy.add(chat_id)
+                    op = queue.popleft()
+                    # Served chats go to the back, so busy chats cannot starve the others
+                    del self._queues[chat_id]
+                    if queue:
+                        self._queues[chat_id] = queue
+                    return chat_id, op
+                self._cond.wait(wait)
+
+    def _retry(self, chat_id, op, seconds):
+        with self._cond:
+            self._bucket(chat_id, time.monotonic()).pause(seconds)
+            self._queues.setdefault(chat_id, deque()).appendleft(op)
+
+    def _work(self):
+        while True:
+            chat_id, op = self._next()
+            try:
+                op.run(self.bot)
+            except apihelper.ApiTelegramException as e:
+                if e.error_code == 429:
+                    self._retry(chat_id, op, e.result_json.get('parameters', {}).get('retry_after', 5))
+                else:
+                    print(f"Sending to {chat_id} failed: {e}")
+                    op.fail(e)
+            except Exception as e:
+                traceback.print_exc()
+                op.fail(e)
+            finally:
+                with self._cond:
+                    self._busy.discard(chat_id)
+                    self._cond.notify_all()
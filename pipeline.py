@@ -0,0 +1,79 @@
+# pipeline.py
+
+import queue
+import threading
+import traceback
+from collections import namedtuple
+
+Stage = namedtuple('Stage', ['name', 'func', 'workers'])
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Passes items through a chain of stages, each with its own worker threads. Stages are
+    connected by bounded queues, so a slow stage holds back the ones before it. A stage
+    function returns the item for the next stage, or None to drop it.
+    """
+
+    def __init__(self, stages, maxsize=8, on_error=None):
+        self.stages = stages
+        self.on_error = on_error
+        self._queues = [queue.Queue(maxsize) for _ in stages]
+        self._threads = []
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            threads = []
+            for i in range(max(stage.workers, 1)):
+                thread = threading.Thread(target=self._work, args=(index,), name=f'{stage.name}-{i}', daemon=True)
+                thread.start()
+                threads.append(thread)
+            self._threads.append(threads)
+        return self
+
+    def put(self, item, stage=None):
+        """
+        Queues `item` for the first stage, or for the stage named `stage`. Blocks while
+        that stage is saturated.
+        """
+        index = 0 if stage is None else [s.name for s in self.stages].index(stage)
+        self._queues[index].put(item)
+
+    def depth(self):
+        return [q.qsize() for q in self._queues]
+
+    def close(self):
+        # Stop the stages in order, so everything an earlier stage emits is still processed
+        for q, threads in zip(self._queues, self._threads):
+            for _ in threads:
+                q.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    def run(self, items):
+        self.start()
+        for item in items:
+            self.put(item)
+        self.close()
+        return self
+
+    def _work(self, index):
+        stage = self.stages[index]
+        source = self._queues[index]
+        target = self._queues[index + 1] if index + 1 < len(self._queues) else None
+        while True:
+            item = source.get()
+            if item is _DONE:
+                return
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error(stage.name, item, e)
+                else:
+                    traceback.print_exc()
+                continue
+            if result is not None and target is not None:
+                target.put(result)
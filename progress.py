@@ -0,0 +1,61 @@
+# progress.py
+
+import threading
+import traceback
+from collections import namedtuple
+
+Progress = namedtuple('Progress', ['done', 'skipped', 'failed', 'total', 'sent', 'size'])
+
+
+class UploadProgress:
+    """
+    Collects an Uploader's progress events and hands a summary to `render` at most every
+    `interval` seconds, from its own thread. Recording an event is a single dict store, so
+    the upload threads never wait on Telegram or on a lock.
+    """
+
+    def __init__(self, render, total, interval=3):
+        self.render = render
+        self.total = total
+        self.interval = interval
+        self._latest = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __call__(self, event):
+        self._latest[event.filename] = event
+
+    def snapshot(self):
+        # dict.copy() does not release the GIL, so it is safe against concurrent stores
+        events = self._latest.copy().values()
+        counts = {'done': 0, 'skipped': 0, 'failed': 0}
+        sent = size = 0
+        for event in events:
+            if event.kind in counts:
+                counts[event.kind] += 1
+            else:
+                sent += event.sent
+                size += event.total
+        return Progress(counts['done'], counts['skipped'], counts['failed'], self.total, sent, size)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='upload-progress', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        last = None
+        while not self._stop.wait(self.interval):
+            progress = self.snapshot()
+            if progress == last:
+                continue
+            last = progress
+            try:
+                self.render(progress)
+            except Exception:
+                traceback.print_exc()
@@ -1,16 +1,334 @@
 
 import requests
 import json
-import glob
 import os
+import io
 import hashlib
 import sys
+import time
+import random
+import struct
+import sqlite3
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import OrderedDict, namedtuple
+from requests.adapters import HTTPAdapter
+from pipeline import Pipeline, Stage
+from metrics import timed
+
+# kind is one of 'started', 'sent', 'done', 'skipped' or 'failed'; sent and total are in bytes
+ProgressEvent = namedtuple('ProgressEvent', ['kind', 'filename', 'sent', 'total'])
 
 class ServerError(Exception):
     pass
 
+class AuthError(ValueError):
+    pass
+
+class MultipartEncoder:
+    """
+    File-like multipart/form-data body that reads the file part from disk as the
+    socket drains, instead of building the whole body in memory. `callback` is
+    called with the bytes sent so far and the total body size.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fields, file_field, file_path, callback=None):
+        self.boundary = os.urandom(16).hex()
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        self.callback = callback
+
+        head = b''
+        for name, value in fields.items():
+            if value is None:
+                continue
+            head += self._part_header(f'form-data; name="{self._quote(name)}"') + f'{value}\r\n'.encode()
+        filename = self._quote(os.path.basename(file_path))
+        head += self._part_header(f'form-data; name="{self._quote(file_field)}"; filename="{filename}"',
+                                  'application/octet-stream')
+
+        self._file = open(file_path, 'rb')
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(f'\r\n--{self.boundary}--\r\n'.encode())]
+        self._current = 0
+        self.len = len(head) + os.fstat(self._file.fileno()).st_size + len(self._parts[2].getvalue())
+        self.bytes_read = 0
+
+    def _part_header(self, disposition, content_type=None):
+        header = f'--{self.boundary}\r\nContent-Disposition: {disposition}\r\n'
+        if content_type:
+            header += f'Content-Type: {content_type}\r\n'
+        return (header + '\r\n').encode()
+
+    @staticmethod
+    def _quote(value):
+        return str(value).replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while chunk := self.read(self.CHUNK_SIZE):
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        chunks = []
+        while size > 0 and self._current < len(self._parts):
+            data = self._parts[self._current].read(size)
+            if not data:
+                self._current += 1
+                continue
+            chunks.append(data)
+            size -= len(data)
+        data = b''.join(chunks)
+        if data:
+            self.bytes_read += len(data)
+            if self.callback:
+                self.callback(self.bytes_read, self.len)
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of uploads in flight, between `min_limit` and `max_limit`.
+    The limit grows by one for every `limit` uploads that finish cleanly and is halved
+    on a 429/5xx, a transport error, or when the time per byte degrades to `SLOWDOWN`
+    times the best seen. One instance can be shared to put a cap across uploaders.
+    """
+
+    SLOWDOWN = 2.0
+    COOLDOWN = 2.0
+    MIN_SAMPLE_BYTES = 64 * 1024
+
+    def __init__(self, min_limit=1, max_limit=6, initial=None):
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial or min_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._best = None
+        self._average = None
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes=0, seconds=0.0, overloaded=False):
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                self._decrease()
+            elif nbytes and seconds > 0:
+                cost = seconds / max(nbytes, self.MIN_SAMPLE_BYTES)
+                self._best = cost if self._best is None else min(self._best, cost)
+                self._average = cost if self._average is None else 0.8 * self._average + 0.2 * cost
+                if self._average > self.SLOWDOWN * self._best:
+                    self._decrease()
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = time.monotonic()
+        # Failures of uploads that were already in flight belong to the same congestion event
+        if now - self._last_decrease < self.COOLDOWN:
+            return
+        self._last_decrease = now
+        self._average = None
+        self.limit = max(self.min_limit, self.limit / 2)
+
+class RemoteMD5Cache:
+    """
+    Per-account cache of the MD5s already in the iBroadcast library, kept as sets of
+    16-byte digests. Refreshed from the server once `ttl` seconds have passed and
+    persisted to `directory` (if given) between runs.
+    """
+
+    HEADER = struct.Struct('<d')
+
+    def __init__(self, directory=None, ttl=3600, max_accounts=100):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_accounts = max_accounts
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, account, fetch):
+        with self._lock:
+            entry = self._entries.get(account) or self._load(account)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                self._remember(account, entry)
+                return entry[1]
+
+        digests = {bytes.fromhex(md5) for md5 in fetch()}
+        entry = (time.time(), digests)
+        with self._lock:
+            self._remember(account, entry)
+            self._save(account, entry)
+        return digests
+
+    def add(self, account, md5):
+        digest = bytes.fromhex(md5)
+        with self._lock:
+            entry = self._entries.get(account)
+            if entry is None or digest in entry[1]:
+                return
+            entry[1].add(digest)
+            if self.directory:
+                with open(self._path(account), 'ab') as fh:
+                    fh.write(digest)
+
+    def invalidate(self, account):
+        with self._lock:
+            self._entries.pop(account, None)
+            if self.directory and os.path.exists(self._path(account)):
+                os.unlink(self._path(account))
+
+    def _remember(self, account, entry):
+        self._entries[account] = entry
+        self._entries.move_to_end(account)
+        while len(self._entries) > self.max_accounts:
+            self._entries.popitem(last=False)
+
+    def _path(self, account):
+        return os.path.join(self.directory, f'{account}.md5')
+
+    def _load(self, account):
+        if not self.directory or not os.path.exists(self._path(account)):
+            return None
+        with open(self._path(account), 'rb') as fh:
+            data = fh.read()
+        if len(data) < self.HEADER.size:
+            return None
+        fetched, = self.HEADER.unpack_from(data)
+        body = memoryview(data)[self.HEADER.size:]
+        return fetched, {bytes(body[i:i + 16]) for i in range(0, len(body) - 15, 16)}
+
+    def _save(self, account, entry):
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f'{self._path(account)}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as fh:
+            fh.write(self.HEADER.pack(entry[0]))
+            fh.write(b''.join(entry[1]))
+        os.replace(temp_path, self._path(account))
+
+
+def _thread_connection(local, path):
+    # One connection per thread, files are hashed and uploaded by several threads at once
+    conn = getattr(local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        local.conn = conn
+    return conn
+
+
+class LocalMD5Cache:
+    """
+    MD5s of local files in SQLite, keyed by absolute path, size and mtime, so an edited
+    file is hashed again. Entries are upserted one by one and looked up by key, so the
+    cost does not grow with the number of cached files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS md5s
+            (path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            md5 TEXT NOT NULL)
+        ''')
+
+    def _connect(self):
+        return _thread_connection(self._local, self.path)
+
+    def get(self, path, size, mtime_ns):
+        row = self._connect().execute("SELECT md5 FROM md5s WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                      (os.path.abspath(path), size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def put(self, path, size, mtime_ns, md5):
+        self._connect().execute('''
+            INSERT INTO md5s (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, md5 = excluded.md5
+        ''', (os.path.abspath(path), size, mtime_ns, md5))
+
+
+class RunManifest:
+    """
+    Per-file state of an upload run ('hashed', 'uploaded', 'skipped' or 'failed'), so an
+    interrupted run can be resumed without redoing the files it already finished.
+    """
+
+    DONE = ('uploaded', 'skipped')
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = _thread_connection(self._local, path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS files
+            (path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            md5 TEXT,
+            state TEXT NOT NULL)
+        ''')
+        if not resume:
+            conn.execute("DELETE FROM files")
+
+    @classmethod
+    def for_directory(cls, directory, resume=False):
+        name = hashlib.md5(os.path.abspath(directory).encode()).hexdigest()
+        return cls(os.path.join(os.path.expanduser('~/.ibroadcast_runs'), f'{name}.db'), resume)
+
+    def done(self, paths):
+        """
+        Returns the paths that a previous run finished and that have not changed since.
+        """
+        rows = _thread_connection(self._local, self.path).execute(
+            f"SELECT path, size, mtime_ns FROM files WHERE state IN {self.DONE}").fetchall()
+        finished = {path: (size, mtime_ns) for path, size, mtime_ns in rows}
+        done = []
+        for path in paths:
+            if path in finished:
+                stat = os.stat(path)
+                if finished[path] == (stat.st_size, stat.st_mtime_ns):
+                    done.append(path)
+        return done
+
+    def record(self, path, state, md5=None):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Gone since the run started, there is nothing to resume
+            return
+        _thread_connection(self._local, self.path).execute('''
+            INSERT INTO files (path, size, mtime_ns, md5, state) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                size = excluded.size, mtime_ns = excluded.mtime_ns, md5 = COALESCE(excluded.md5, md5), state = excluded.state
+        ''', (path, stat.st_size, stat.st_mtime_ns, md5, state))
+
+
 class Uploader:
     """
     Class for uploading content to iBroadcast.
@@ -21,11 +339,21 @@ class Uploader:
     DEVICE_NAME = 'python 3 uploader script'
     USER_AGENT = f'ibroadcast-uploader/{VERSION}'
 
-    def __init__(self, login_token, directory, no_cache, verbose, silent, skip_confirmation, parallel_uploads, playlist, tag, reupload):
-        self.login_token = login_token
+    API_URL = 'https://api.ibroadcast.com/s/JSON/'
+    UPLOAD_URL = 'https://upload.ibroadcast.com'
 
-        if directory:
-            os.chdir(directory)
+    TIMEOUT = (10, 60)
+    UPLOAD_TIMEOUT = (10, 300)
+    RETRIES = 4
+    UPLOAD_RETRIES = 2
+    HASH_BUFFER_SIZE = 1024 * 1024
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    BACKOFF = 0.5
+    BACKOFF_CAP = 30
+
+    def __init__(self, login_token, directory, no_cache, verbose, silent, skip_confirmation, parallel_uploads, playlist, tag, reupload, max_parallel_uploads=None):
+        self.login_token = login_token
+        self.directory = os.path.abspath(directory or os.getcwd())
 
         self.be_verbose = verbose
         self.be_silent = silent
@@ -38,24 +366,64 @@ class Uploader:
         self.files = []
         self.skipped_files = []
         self.failed_files = []
-        self.md5_int_path = os.path.expanduser('~/.ibroadcast_md5s')
-        self.md5_int = {}
+        self.uploaded_files = []
+        self.md5_int_path = os.path.expanduser('~/.ibroadcast_md5s.db')
+        self.md5_int = None
         self.md5_ext = None
+        self.md5_ext_cache = None
+        self.known_md5 = {}
+        self.file_md5 = {}
+        self.on_progress = None
+        # Called with (stage, seconds, outcome) after the network and hashing steps
+        self.observe = None
+        self.hash_workers = 4
+        self.manifest = None
         self.reupload = reupload
         self.tag = tag
         self.playlist = playlist
         self.parallel_uploads = parallel_uploads
+        self.max_parallel_uploads = max(max_parallel_uploads or parallel_uploads, parallel_uploads)
+        self.session = self.create_session(self.max_parallel_uploads)
+        self.limiter = AdaptiveLimiter(1, self.max_parallel_uploads, initial=parallel_uploads)
+
+    @staticmethod
+    def create_session(pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max(pool_size, 1))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def retry(self, send, retries):
+        for attempt in range(retries + 1):
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == retries:
+                    return response
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    time.sleep(min(int(retry_after), self.BACKOFF_CAP))
+                    continue
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF * 2 ** attempt)))
 
     def process(self):
         try:
-            self.login()
-            self.get_supported_types()
+            if self.token is None:
+                self.login()
+            if self.supported is None:
+                self.get_supported_types()
             self.load_files()
             if self.confirm():
                 self.prepare_upload()
         except (ServerError, ValueError) as e:
             print(f'Error: {e}')
 
+    @timed('login')
     def login(self):
         if self.be_verbose:
             print('Logging in...')
@@ -70,19 +438,19 @@ class Uploader:
             'device_name': self.DEVICE_NAME,
             'user_agent': self.USER_AGENT
         }
-        response = requests.post(
-            "https://api.ibroadcast.com/s/JSON/",
+        response = self.retry(lambda: self.session.post(
+            self.API_URL,
             data=json.dumps(post_data),
-            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT}
-        )
+            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT},
+            timeout=self.TIMEOUT
+        ), self.RETRIES)
 
-        if not response.ok:
-            raise ServerError(f'Server returned bad status: {response.status_code}')
+        self.check_response(response)
 
         jsoned = response.json()
 
         if 'user' not in jsoned:
-            raise ValueError(jsoned.get('message', 'Login failed'))
+            raise AuthError(jsoned.get('message', 'Login failed'))
 
         self.user_id = jsoned['user']['id']
         self.token = jsoned['user']['token']
@@ -90,6 +458,13 @@ class Uploader:
         if self.be_verbose:
             print('Login successful - user_id:', self.user_id)
 
+    def check_response(self, response):
+        if response.status_code in (401, 403):
+            raise AuthError(f'Server rejected credentials: {response.status_code}')
+        if not response.ok:
+            raise ServerError(f'Server returned bad status: {response.status_code}')
+
+    @timed('get_supported_types')
     def get_supported_types(self):
         if self.be_verbose:
             print('Fetching account info...')
@@ -104,41 +479,45 @@ class Uploader:
             'device_name': self.DEVICE_NAME,
             'user_agent': self.USER_AGENT
         }
-        response = requests.post(
-            "https://api.ibroadcast.com/s/JSON/",
+        response = self.retry(lambda: self.session.post(
+            self.API_URL,
             data=json.dumps(post_data),
-            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT}
-        )
+            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT},
+            timeout=self.TIMEOUT
+        ), self.RETRIES)
 
-        if not response.ok:
-            raise ServerError(f'Server returned bad status: {response.status_code}')
+        self.check_response(response)
 
         jsoned = response.json()
 
         if 'user' not in jsoned:
-            raise ValueError(jsoned.get('message', 'Failed to fetch account info'))
+            raise AuthError(jsoned.get('message', 'Failed to fetch account info'))
 
         self.supported = [filetype['extension'] for filetype in jsoned.get('supported', [])]
 
         if self.be_verbose:
             print('Account info fetched')
 
+    def resume_session(self, user_id, token, supported):
+        self.user_id = user_id
+        self.token = token
+        self.supported = supported
+
     def load_files(self, directory=None):
         if self.supported is None:
             raise ValueError('Supported types not set. Have you logged in yet?')
 
-        directory = directory or os.getcwd()
-
-        for full_filename in glob.glob(os.path.join(glob.escape(directory), '*')):
-            if os.path.basename(full_filename).startswith('.'):
-                continue
-
-            if os.path.isdir(full_filename):
-                self.load_files(full_filename)
-                continue
-
-            if os.path.splitext(full_filename)[1] in self.supported:
-                self.files.append(full_filename)
+        # scandir gets the file type from the directory listing, without a stat per entry
+        pending = [directory or self.directory]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                    elif os.path.splitext(entry.name)[1] in self.supported:
+                        self.files.append(entry.path)
 
     def confirm(self):
         if self.skip_confirmation:
@@ -164,120 +543,215 @@ class Uploader:
         return False
 
     def __load_md5_int(self):
-        if os.path.exists(self.md5_int_path):
-            with open(self.md5_int_path) as json_file:
-                self.md5_int = json.load(json_file)
-        else:
-            self.md5_int = {}
+        if self.md5_int is None and not self.no_cache:
+            self.md5_int = LocalMD5Cache(self.md5_int_path)
 
+    @timed('load_md5_ext')
     def __load_md5_ext(self):
+        if self.reupload:
+            # Nothing is skipped, so there is no need to fetch the library
+            self.md5_ext = set()
+        elif self.md5_ext_cache is not None:
+            self.md5_ext = self.md5_ext_cache.get(self.user_id, self.__fetch_md5_ext)
+        else:
+            self.md5_ext = {bytes.fromhex(md5) for md5 in self.__fetch_md5_ext()}
+
+    def __fetch_md5_ext(self):
         post_data = {
             'user_id': self.user_id,
             'token': self.token
         }
-        response = requests.post(
-            "https://upload.ibroadcast.com",
+        response = self.retry(lambda: self.session.post(
+            self.UPLOAD_URL,
             data=post_data,
-            headers={'Content-Type': 'application/x-www-form-urlencoded'}
-        )
+            headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            timeout=self.TIMEOUT
+        ), self.RETRIES)
 
-        if not response.ok:
-            raise ServerError(f'Server returned bad status: {response.status_code}')
+        self.check_response(response)
 
         jsoned = response.json()
-        self.md5_ext = jsoned.get('md5', {})
+        return jsoned.get('md5', [])
 
+    @timed('calcmd5')
     def calcmd5(self, file_path):
-        with open(file_path, 'rb') as fh:
-            m = hashlib.md5()
-            while chunk := fh.read(8192):
-                m.update(chunk)
+        m = hashlib.md5()
+        buffer = bytearray(self.HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        # hashlib releases the GIL on large buffers, so the hash workers run in parallel
+        with open(file_path, 'rb', buffering=0) as fh:
+            while size := fh.readinto(buffer):
+                m.update(view[:size])
         return m.hexdigest()
 
-    def check_md5(self):
-        self.__load_md5_int()
-        self.__load_md5_ext()
-
-        file_list = self.progressbar(self.files, "Calculating MD5 hashes: ", 60) if not self.be_silent and not self.be_verbose else self.files
-
-        for filename in file_list:
-            if filename in self.md5_int and not self.no_cache:
-                file_md5 = self.md5_int[filename]
-            else:
+    def lookup_md5(self, filename):
+        if filename in self.known_md5:
+            file_md5 = self.known_md5[filename]
+        else:
+            stat = os.stat(filename)
+            file_md5 = self.md5_int.get(filename, stat.st_size, stat.st_mtime_ns) if self.md5_int is not None else None
+            if file_md5 is None:
                 if not self.be_silent and self.be_verbose:
-                    print(f'Calculating MD5 for file "{filename}"... ', end='')
+                    print(f'Calculating MD5 for file "{filename}"... ')
                 file_md5 = self.calcmd5(filename)
-                self.md5_int[filename] = file_md5
-
-            if file_md5 in self.md5_ext and not self.reupload:
-                self.skipped_files.append(filename)
-                if not self.be_silent and self.be_verbose:
-                    print(f'Skipping "{filename}", already uploaded.')
-                self.files.remove(filename)
-            elif not self.be_silent and self.be_verbose:
-                print(f'The MD5 for "{filename}" is cached, but the file has not been uploaded yet.')
-
-        with open(self.md5_int_path, 'w') as fp:
-            json.dump(self.md5_int, fp, indent=2)
-
-    def progressbar(self, it, prefix="", size=60, out=sys.stdout):
-        count = len(it)
-        def show(j):
-            x = int(size * j / count)
-            print(f"{prefix}[{'#' * x}{'.' * (size - x)}] {j}/{count}", end='\r', file=out, flush=True)
-        if not self.be_silent and not self.be_verbose:
-            show(0)
-        for i, item in enumerate(it):
-            yield item
-            if not self.be_silent and not self.be_verbose:
-                show(i + 1)
-        if not self.be_silent and not self.be_verbose:
+                if self.md5_int is not None:
+                    self.md5_int.put(filename, stat.st_size, stat.st_mtime_ns, file_md5)
+        self.file_md5[filename] = file_md5
+        return file_md5
+
+    def in_library(self, file_md5):
+        if self.md5_ext is None:
+            self.__load_md5_ext()
+        return not self.reupload and bytes.fromhex(file_md5) in self.md5_ext
+
+    def emit(self, kind, filename, sent=0, total=0):
+        if self.on_progress:
+            self.on_progress(ProgressEvent(kind, filename, sent, total))
+
+    def __skip(self, filename):
+        self.skipped_files.append(filename)
+        self.emit('skipped', filename)
+        if not self.be_silent and self.be_verbose:
+            print(f'Skipping "{filename}", already uploaded.')
+
+    def progressbar(self, done, count, prefix="", size=60, out=sys.stdout):
+        x = int(size * done / count) if count else size
+        print(f"{prefix}[{'#' * x}{'.' * (size - x)}] {done}/{count}", end='\r', file=out, flush=True)
+        if done == count:
             print("\n", flush=True, file=out)
 
     def prepare_upload(self):
         total_files = len(self.files)
-        self.check_md5()
-        not_skipped_files = len(self.files)
-
-        if not_skipped_files > 0:
-            with ThreadPoolExecutor(max_workers=self.parallel_uploads) as executor:
-                for filename in self.files:
-                    executor.submit(self.upload, filename)
+        self.__load_md5_int()
+        self.__load_md5_ext()
+        files, self.files = self.files, []
+        manifest = self.manifest
+
+        if manifest is not None:
+            done = set(manifest.done(files))
+            for filename in done:
+                self.__skip(filename)
+            files = [filename for filename in files if filename not in done]
+
+        show_progress = files and not self.be_silent and not self.be_verbose
+        hashed = []
+        hashed_lock = threading.Lock()
+        if show_progress:
+            self.progressbar(0, len(files), "Calculating MD5 hashes: ")
+
+        def hash_file(filename):
+            try:
+                file_md5 = self.lookup_md5(filename)
+            finally:
+                if show_progress:
+                    with hashed_lock:
+                        hashed.append(filename)
+                        self.progressbar(len(hashed), len(files), "Calculating MD5 hashes: ")
+            if manifest is not None:
+                manifest.record(filename, 'hashed', file_md5)
+            return filename, file_md5
+
+        def dedupe(item):
+            filename, file_md5 = item
+            if self.in_library(file_md5):
+                self.__skip(filename)
+                if manifest is not None:
+                    manifest.record(filename, 'skipped')
+                return None
+            self.files.append(filename)
+            return filename
+
+        def upload(filename):
+            self.upload(filename)
+            if manifest is not None:
+                manifest.record(filename, 'uploaded')
+
+        def report(stage, item, error):
+            filename = item[0] if isinstance(item, tuple) else item
+            if filename not in self.failed_files:
+                # upload() records its own failures
+                self.failed_files.append(filename)
+                self.emit('failed', filename)
+            if manifest is not None:
+                manifest.record(filename, 'failed')
+            if not self.be_silent:
+                print(f'Failed ({stage}): {filename}: {error}')
+
+        # Each file is uploaded as soon as it is hashed and checked, instead of hashing everything first
+        Pipeline([
+            Stage('hash', hash_file, self.hash_workers),
+            Stage('dedupe', dedupe, 1),
+            # Upload workers wait on the limiter, which decides how many uploads are actually in flight
+            Stage('upload', upload, self.limiter.max_limit),
+        ], maxsize=self.limiter.max_limit * 2, on_error=report).run(files)
 
         skipped = len(self.skipped_files)
         failed = len(self.failed_files)
-        uploaded = max(total_files - skipped - failed, 0)
+        uploaded = len(self.uploaded_files)
         print(f'Uploaded/Skipped/Failed/Total: {uploaded}/{skipped}/{failed}/{total_files}.')
 
+    @timed('upload')
     def upload(self, filename):
         if not self.be_silent:
             print('Uploading:', filename)
 
-        with open(filename, 'rb') as upload_file:
-            file_data = {'file': upload_file}
-            post_data = {
-                'user_id': self.user_id,
-                'token': self.token,
-                'file_path': filename,
-                'method': self.CLIENT,
-                'tag-name': self.tag,
-                'playlist-name': self.playlist
-            }
-
-            response = requests.post(
-                "https://upload.ibroadcast.com",
-                data=post_data,
-                files=file_data,
-            )
-
-            if not response.ok:
-                self.failed_files.append(filename)
-                raise ServerError(f'Server returned bad status: {response.status_code}')
+        post_data = {
+            'user_id': self.user_id,
+            'token': self.token,
+            'file_path': filename,
+            'method': self.CLIENT,
+            'tag-name': self.tag,
+            'playlist-name': self.playlist
+        }
 
-            jsoned = response.json()
-            if not jsoned.get('result', False):
-                self.failed_files.append(filename)
+        progress = None
+        if self.on_progress:
+            progress = lambda sent, total: self.on_progress(ProgressEvent('sent', filename, sent, total))
+
+        def send():
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                with MultipartEncoder(post_data, 'file', filename, progress) as body:
+                    self.emit('started', filename, 0, body.len)
+                    response = self.session.post(
+                        self.UPLOAD_URL,
+                        data=body,
+                        headers={'Content-Type': body.content_type},
+                        timeout=self.UPLOAD_TIMEOUT
+                    )
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.release(overloaded=True)
+                raise
+            except Exception:
+                self.limiter.release()
+                raise
+            if response.status_code in self.RETRY_STATUSES:
+                self.limiter.release(overloaded=True)
+            elif response.ok:
+                self.limiter.release(body.len, time.monotonic() - started)
+            else:
+                self.limiter.release()
+            return response
+
+        try:
+            response = self.retry(send, self.UPLOAD_RETRIES)
+            self.check_response(response)
+            if not response.json().get('result', False):
                 raise ValueError('File upload failed.')
+        except Exception:
+            # Including files that cannot be read and answers that are not JSON
+            self.failed_files.append(filename)
+            self.emit('failed', filename)
+            raise
+        self.uploaded_files.append(filename)
+        self.emit('done', filename)
+
+        file_md5 = self.file_md5.get(filename)
+        if file_md5 and self.md5_ext_cache is not None:
+            self.md5_ext_cache.add(self.user_id, file_md5)
+        elif file_md5:
+            self.md5_ext.add(bytes.fromhex(file_md5))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run this script in the parent directory of your music files. To acquire a login token, enable the \"Simple Uploaders\" app by visiting https://ibroadcast.com, logging in to your account, and clicking the \"Apps\" button in the side menu.")
@@ -286,13 +760,26 @@ if __name__ == '__main__':
     parser.add_argument('directory', type=str, nargs='?', help='Use this directory instead of the current one')
     parser.add_argument('-n', '--no-cache', action='store_true', help='Do not use local MD5 cache')
     parser.add_argument('-v', '--verbose', action='store_true', help='Be verbose')
-    parser.add_argument('-p', '--parallel-uploads', type=int, nargs='?', const=3, default=3, choices=range(1, 7), metavar='1-6', help='Number of parallel uploads, 3 by default.')
+    parser.add_argument('-p', '--parallel-uploads', type=int, nargs='?', const=3, default=3, choices=range(1, 17), metavar='1-16', help='Number of parallel uploads to start with, 3 by default.')
+    parser.add_argument('-P', '--max-parallel-uploads', type=int, default=16, choices=range(1, 33), metavar='1-32', help='Upper bound for the adaptive number of parallel uploads, 16 by default.')
     parser.add_argument('-s', '--silent', action='store_true', help='Be silent')
     parser.add_argument('-y', '--skip-confirmation', action='store_true', help='Skip confirmation dialogue')
     parser.add_argument('-l', '--playlist', type=str, help='Add uploaded files to this playlist')
     parser.add_argument('-t', '--tag', type=str, help='Apply this tag to the uploaded files')
     parser.add_argument('-r', '--reupload', action='store_true', help='Force re-uploading files')
 
+    parser.add_argument('--library-cache-ttl', type=int, default=3600, metavar='SECONDS', help='How long the list of already uploaded files is cached, 3600 by default.')
+    parser.add_argument('--hash-workers', type=int, default=4, metavar='N', help='Number of files hashed at once, 4 by default.')
+    parser.add_argument('--resume', action='store_true', help='Skip the files an interrupted run of this directory already finished')
+    parser.add_argument('--api-url', type=str, default=Uploader.API_URL, help='Base URL of the iBroadcast API')
+    parser.add_argument('--upload-url', type=str, default=Uploader.UPLOAD_URL, help='URL of the iBroadcast upload endpoint')
+
     args = parser.parse_args()
-    uploader = Uploader(args.login_token, args.directory, args.no_cache, args.verbose, args.silent, args.skip_confirmation, args.parallel_uploads, args.playlist, args.tag, args.reupload)
+    Uploader.API_URL = args.api_url
+    Uploader.UPLOAD_URL = args.upload_url
+    uploader = Uploader(args.login_token, args.directory, args.no_cache, args.verbose, args.silent, args.skip_confirmation, args.parallel_uploads, args.playlist, args.tag, args.reupload, args.max_parallel_uploads)
+    uploader.hash_workers = args.hash_workers
+    uploader.manifest = RunManifest.for_directory(uploader.directory, args.resume)
+    if not args.no_cache:
+        uploader.md5_ext_cache = RemoteMD5Cache(os.path.expanduser('~/.ibroadcast_library_md5s'), ttl=args.library_cache_ttl)
     uploader.process()
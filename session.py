@@ -0,0 +1,48 @@
+# session.py
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+Session = namedtuple('Session', ['login_token', 'user_id', 'token', 'supported', 'created'])
+
+
+class SessionCache:
+    """
+    In-process store of authenticated iBroadcast sessions, keyed by Telegram user id.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted
+    once `max_size` is reached.
+    """
+
+    def __init__(self, ttl=3600, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return None
+            if time.monotonic() - session.created > self.ttl:
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return session
+
+    def put(self, key, login_token, user_id, token, supported):
+        session = Session(login_token, user_id, token, supported, time.monotonic())
+        with self._lock:
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+        return session
+
+    def invalidate(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+    def __len__(self):
+        return len(self._sessions)
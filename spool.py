@@ -0,0 +1,93 @@
+# spool.py
+
+import os
+import threading
+import traceback
+from collections import defaultdict
+
+
+class SpoolManager:
+    """
+    Looks after the uploads/ spool: reconciles it with the file index on startup and
+    periodically evicts pending files that were never uploaded. With `owns` set, only the
+    directories of users for which it returns True are looked after.
+    """
+
+    def __init__(self, root, file_index, budget, max_age, on_evict=None, owns=None, interval=10 * 60):
+        self.root = root
+        self.file_index = file_index
+        self.budget = budget
+        self.max_age = max_age
+        self.on_evict = on_evict
+        self.owns = owns
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def used(self):
+        return self.file_index.total_usage()
+
+    def reconcile(self):
+        """
+        Brings the index in line with what is on disk after a crash or restart.
+        Returns the ids of users that still have files waiting to be uploaded.
+        """
+        indexed = {path for user_id, path in self.file_index.pending() if self._owned(user_id)}
+        on_disk = set()
+        os.makedirs(self.root, exist_ok=True)
+        for user_id in os.listdir(self.root):
+            if not self._owned(user_id):
+                continue
+            directory = os.path.join(self.root, user_id)
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if not entry.is_file():
+                    continue
+                if entry.name.startswith('.'):
+                    # Leftover temp file of a download that never finished
+                    os.unlink(entry.path)
+                    continue
+                on_disk.add(entry.path)
+                if entry.path not in indexed:
+                    # The MD5 is unknown, Uploader.lookup_md5 will compute it
+                    self.file_index.add(user_id, entry.path, entry.stat().st_size, None)
+
+        for path in indexed - on_disk:
+            self.file_index.discard(path)
+
+        return sorted({user_id for user_id, _ in self.file_index.pending() if self._owned(user_id)})
+
+    def _owned(self, user_id):
+        return self.owns is None or self.owns(user_id)
+
+    def evict_stale(self):
+        evicted = defaultdict(list)
+        for user_id, path in self.file_index.stale(self.max_age):
+            if not self._owned(user_id):
+                continue
+            # Claimed in the index first, so a file an upload has just picked up is not deleted
+            if not self.file_index.evict(path):
+                continue
+            if os.path.exists(path):
+                os.unlink(path)
+            evicted[user_id].append(os.path.basename(path))
+
+        if self.on_evict:
+            for user_id, names in evicted.items():
+                self.on_evict(user_id, names)
+        return evicted
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='spool-manager', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.evict_stale()
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,85 @@
+# webhook.py
+
+import hmac
+import ssl
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import telebot
+
+
+class WebhookServer:
+    """
+    Small HTTP server receiving Telegram updates in webhook mode. Requests are checked
+    against the secret token and the updates handed to a bounded pool of workers; when
+    the pool and its backlog are full the request is refused so Telegram retries it later.
+    """
+
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self, bot, host='0.0.0.0', port=8443, path='/', secret_token=None, workers=8, backlog=64,
+                 certfile=None, keyfile=None):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook')
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path != server.path:
+                    return self.reply(404)
+                # Compared as bytes, since compare_digest() rejects non-ASCII strings
+                if server.secret_token and not hmac.compare_digest(
+                        self.headers.get(server.SECRET_HEADER, '').encode('latin-1'), server.secret_token.encode()):
+                    return self.reply(403)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    update = telebot.types.Update.de_json(body.decode('utf-8'))
+                except (ValueError, KeyError, TypeError):
+                    update = None
+                if update is None:
+                    return self.reply(400)
+                self.reply(200 if server.submit(update) else 503)
+
+        return Handler
+
+    def submit(self, update):
+        if not self._slots.acquire(timeout=5):
+            return False
+        future = self._executor.submit(self.bot.process_new_updates, [update])
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception():
+            traceback.print_exception(future.exception())
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self._executor.shutdown(wait=True)